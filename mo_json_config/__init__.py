@@ -7,11 +7,36 @@
 #
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
-from mo_json_config.configuration import Configuration
-from mo_json_config.expander import get, get_file, expand
+from mo_json_config.configuration import Configuration, FrozenConfiguration, LayeredConfiguration
+from mo_json_config.dependencies import DependencyGraph
+from mo_json_config.expander import get, get_file, expand, get_async, expand_async
 from mo_json_config.expand_locals import is_url
+from mo_json_config.plan import compile, Plan
+from mo_json_config.registry import register_scheme
+from mo_json_config.snapshot import SnapshotCache
+from mo_json_config.tracing import TraceSummary
+from mo_json_config.watch import watch, Watcher
 
-__all__ = ["get", "get_file", "expand", "configuration", "Configuration", "is_url"]
+__all__ = [
+    "get",
+    "get_file",
+    "expand",
+    "get_async",
+    "expand_async",
+    "compile",
+    "Plan",
+    "TraceSummary",
+    "DependencyGraph",
+    "SnapshotCache",
+    "register_scheme",
+    "watch",
+    "Watcher",
+    "configuration",
+    "Configuration",
+    "LayeredConfiguration",
+    "FrozenConfiguration",
+    "is_url",
+]
 
 
 configuration = Configuration({})
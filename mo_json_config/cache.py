@@ -0,0 +1,429 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import os
+import sys
+from collections import OrderedDict, namedtuple
+from copy import copy
+from functools import lru_cache
+from hashlib import sha256
+from threading import Lock, Thread
+from time import monotonic
+
+from mo_dots import from_data
+from mo_files import File
+from mo_files.url import URL, value2url_param
+from mo_imports import delay_import
+from mo_logs import Except, logger
+
+from mo_json_config.registry import async_scheme_loaders, scheme_loaders
+from mo_json_config.tracing import Span, _span, record
+
+_copy = delay_import("mo_json_config.expand_locals._copy")
+
+NOTSET = {}
+MAX_ENTRIES = 1000
+MAX_BYTES = 64 * 1024 * 1024
+MAX_URLS = 4096
+
+# ttl - SECONDS A LOADED VALUE IS USED
+# stale - SECONDS AFTER ttl THE OLD VALUE IS STILL USED, WHILE IT IS LOADED AGAIN IN THE BACKGROUND
+# negative_ttl - SECONDS A FAILURE IS REMEMBERED, SO THE BACKEND IS NOT ASKED AGAIN
+Policy = namedtuple("Policy", ["ttl", "stale", "negative_ttl"])
+
+
+class DocumentCache:
+    """
+    PROCESS-WIDE LRU OF PARSED DOCUMENTS, KEYED BY ABSOLUTE PATH (AND QUERY)
+    AN ENTRY IS ONLY USED IF THE FILE (mtime, size, inode) HAS NOT CHANGED
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, normalize=None):
+        """
+        :param normalize: FUNCTION FROM THE path GIVEN TO invalidate() TO THE FIRST PART OF THE KEY (DEFAULT IS THE ABSOLUTE FILE PATH)
+        """
+        self.normalize = normalize or _abs_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = OrderedDict()  # MAP FROM key TO (fingerprint, value, size)
+        self._lock = Lock()
+
+    def get(self, key, fingerprint):
+        """
+        :return: THE CACHED VALUE, OR NOTSET IF MISSING OR STALE
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != fingerprint:
+                self.misses += 1
+                return NOTSET
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key):
+        """
+        :return: (fingerprint, value) OF THE ENTRY, OR NOTSET IF MISSING (NOT COUNTED AS A HIT OR MISS)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return NOTSET
+            return entry[0], entry[1]
+
+    def set(self, key, fingerprint, value, size=0):
+        with self._lock:
+            if size > self.max_bytes:
+                self._remove(key)
+                return
+            self._remove(key)
+            self._entries[key] = (fingerprint, value, size)
+            self._bytes += size
+            self._evict()
+
+    def resize(self, max_entries=None, max_bytes=None):
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def invalidate(self, path=None):
+        """
+        FORGET THE DOCUMENTS FROM path, OR EVERYTHING IF NO path GIVEN
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            path = self.normalize(path)
+            for key in [k for k in self._entries if k[0] == path]:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._bytes}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+
+
+def file_key(abs_path, query):
+    """
+    THE SAME FILE PARSED WITH DIFFERENT PARAMETERS IS A DIFFERENT DOCUMENT
+    """
+    return abs_path, value2url_param(query) if query else ""
+
+
+def url_key(url, query):
+    """
+    A REMOTE DOCUMENT IS KEYED BY ITS URL, NOT BY A FILE PATH
+    """
+    return _url_path(url), value2url_param(query) if query else ""
+
+
+def _url_path(url):
+    # THE FRAGMENT IS TAKEN FROM THE LOADED VALUE, SO IT DOES NOT MATTER
+    return str(url).partition("#")[0]
+
+
+def _abs_path(path):
+    return File(path).abs_path
+
+
+def file_fingerprint(os_path):
+    """
+    :return: (mtime, size, inode) OF THE FILE, OR None IF IT CAN NOT BE SEEN
+    """
+    try:
+        stat = os.stat(os_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def env_fingerprint(value):
+    # THE VALUE MAY BE SECRET, SO ONLY A HASH
+    return sha256(value.encode("utf8")).hexdigest()[:16]
+
+
+class RemoteCache:
+    """
+    PROCESS-WIDE LRU OF WHAT THE SCHEME LOADERS RETURNED (OR RAISED), FOR
+    SCHEMES GIVEN A Policy. OTHER SCHEMES ARE NOT CACHED AT ALL
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policies = {}  # MAP FROM scheme TO Policy
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self._bytes = 0
+        self._entries = OrderedDict()  # MAP FROM key TO (expires, value, error, fingerprint, size)
+        self._refreshing = set()  # keys BEING LOADED IN THE BACKGROUND
+        self._lock = Lock()
+
+    def set_policy(self, scheme, ttl=0, stale=0, negative_ttl=0):
+        """
+        :param scheme: eg "ssm", "s3", "http"
+        :param ttl: SECONDS A LOADED VALUE IS USED (0 TO STOP CACHING THE scheme)
+        :param stale: SECONDS AFTER ttl THE OLD VALUE IS USED WHILE IT IS LOADED AGAIN IN THE BACKGROUND
+        :param negative_ttl: SECONDS A FAILED LOAD IS REMEMBERED (AND RAISED AGAIN) INSTEAD OF RETRIED
+        """
+        with self._lock:
+            if ttl <= 0 and negative_ttl <= 0:
+                self.policies.pop(scheme, None)
+            else:
+                self.policies[scheme] = Policy(ttl, stale, negative_ttl)
+        self.invalidate(scheme)
+
+    def loader(self, scheme):
+        """
+        :return: THE scheme_loaders FUNCTION, WRAPPED IN THIS CACHE IF scheme HAS A Policy
+        """
+        loader = scheme_loaders[scheme]
+        policy = self.policies.get(scheme)
+        if policy is None:
+            return loader
+
+        def cached(ref, path, url):
+            return self._load(policy, loader, ref, path, url)
+
+        return cached
+
+    def async_loader(self, scheme):
+        """
+        :return: THE async_scheme_loaders FUNCTION (OR None), WRAPPED IN THIS CACHE IF scheme HAS A Policy
+        """
+        loader = async_scheme_loaders.get(scheme)
+        policy = self.policies.get(scheme)
+        if loader is None or policy is None:
+            return loader
+
+        async def cached(ref, path, url):
+            key = _remote_key(ref, url)
+            found = self._get(policy, key)
+            if found is not None:
+                return self._use(found, ref, path, url, None)
+            try:
+                value, fingerprint = await _capture_async(loader, ref, path, url)
+            except Exception as cause:
+                self._set(policy, key, None, cause, None)
+                raise
+            return self._set(policy, key, value, None, fingerprint)
+
+        return cached
+
+    def invalidate(self, scheme=None, url=None):
+        """
+        FORGET WHAT WAS LOADED FROM url, OR WITH scheme, OR EVERYTHING IF NEITHER GIVEN
+        """
+        with self._lock:
+            if scheme is None and url is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            url = None if url is None else str(url)
+            for key in list(self._entries):
+                if (scheme is None or key[0] == scheme) and (url is None or key[1] == url):
+                    self._remove(key)
+
+    flush = invalidate
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale_hits": self.stale_hits,
+                "negative_hits": self.negative_hits,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self, policy, loader, ref, path, url):
+        key = _remote_key(ref, url)
+        found = self._get(policy, key)
+        if found is not None:
+            return self._use(found, ref, path, url, loader)
+        try:
+            value, fingerprint = _capture(loader, ref, path, url)
+        except Exception as cause:
+            self._set(policy, key, None, cause, None)
+            raise
+        return self._set(policy, key, value, None, fingerprint)
+
+    def _get(self, policy, key):
+        """
+        :return: (entry, refresh), OR None IF NOT USABLE
+        """
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value, error, _, _ = entry
+            if now < expires:
+                self._entries.move_to_end(key)
+                if error is None:
+                    self.hits += 1
+                else:
+                    self.negative_hits += 1
+                return entry, False
+            if error is None and now < expires + policy.stale:
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                return entry, key not in self._refreshing
+            self._remove(key)
+            self.misses += 1
+            return None
+
+    def _use(self, found, ref, path, url, loader):
+        (_, value, error, fingerprint, _), refresh = found
+        record(cache_hit=True, fingerprint=fingerprint)
+        if error is not None:
+            raise error
+        if refresh and loader is not None:
+            self._refresh(loader, ref, path, url)
+        return _copy(value)
+
+    def _refresh(self, loader, ref, path, url):
+        key = _remote_key(ref, url)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            # A NEW THREAD HAS A NEW CONTEXT, SO THIS LOAD IS NOT TRACED
+            try:
+                value, fingerprint = _capture(loader, ref, path, url)
+                policy = self.policies.get(key[0])
+                if policy is not None:
+                    self._set(policy, key, value, None, fingerprint)
+            except Exception as cause:
+                # KEEP THE STALE VALUE UNTIL IT IS TOO OLD
+                logger.warning("Can not refresh {url}", url=key[1], cause=Except.wrap(cause))
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        Thread(target=refresh, name="refresh " + key[1], daemon=True).start()
+
+    def _set(self, policy, key, value, error, fingerprint):
+        """
+        :return: A COPY OF value, FOR THE CALLER
+        """
+        ttl = policy.ttl if error is None else policy.negative_ttl
+        if error is None:
+            value = _copy(from_data(value))
+        if ttl > 0:
+            size = _sizeof(value)
+            with self._lock:
+                self._remove(key)
+                if size <= self.max_bytes:
+                    self._entries[key] = (monotonic() + ttl, value, error, fingerprint, size)
+                    self._bytes += size
+                    self._evict()
+        return None if error is not None else _copy(value)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[4]
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[4]
+
+
+def _remote_key(ref, url):
+    return ref.scheme, _url_path(ref), value2url_param(url.query) if url.query else ""
+
+
+def _capture(loader, ref, path, url):
+    """
+    :return: (value, fingerprint), WHERE fingerprint IS WHAT THE LOADER record()ED
+    """
+    span = _span.get()
+    if span is not None:
+        return loader(ref, path, url), span.fingerprint
+    span = Span(ref.scheme, None, path)
+    token = _span.set(span)
+    try:
+        return loader(ref, path, url), span.fingerprint
+    finally:
+        _span.reset(token)
+
+
+async def _capture_async(loader, ref, path, url):
+    span = _span.get()
+    if span is not None:
+        return await loader(ref, path, url), span.fingerprint
+    span = Span(ref.scheme, None, path)
+    token = _span.set(span)
+    try:
+        return await loader(ref, path, url), span.fingerprint
+    finally:
+        _span.reset(token)
+
+
+def _sizeof(value):
+    # ROUGH BYTES OF A JSON VALUE
+    total = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        total += sys.getsizeof(value)
+        if value.__class__ is dict:
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif value.__class__ is list:
+            stack.extend(value)
+    return total
+
+
+file_cache = DocumentCache()
+remote_cache = RemoteCache()
+
+
+def parse_url(text):
+    """
+    :return: A NEW URL, COPIED FROM THE CACHED PARSE OF text, SO THE CALLER MAY CHANGE IT
+    """
+    return copy(_parse_url(text))
+
+
+@lru_cache(maxsize=MAX_URLS)
+def _parse_url(text):
+    # NEVER RETURNED, SO NEVER CHANGED
+    return URL(text)
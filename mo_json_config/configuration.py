@@ -7,19 +7,57 @@
 #
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
+import sys
+from functools import lru_cache
+from threading import Lock
 
-from mo_dots import is_data, join_field, leaves_to_data, concat_field, register_data, Data, from_data
+from mo_dots import (
+    is_data,
+    is_list,
+    join_field,
+    leaves_to_data,
+    concat_field,
+    register_data,
+    Data,
+    from_data,
+    split_field,
+    to_data,
+)
 from mo_future import Mapping
 from mo_logs import logger
 from mo_logs.strings import wordify
 
+from mo_json_config.lazy import LazyData, LazyList, LazyRef
+
+MAX_KEYS = 4096
+SMALL_NODE = 8  # MOST NAMES IN A FrozenConfiguration OBJECT THAT IS SEARCHED, NOT INDEXED
+NOTSET = object()
+_writing = Lock()  # WRITERS TAKE TURNS, READERS NEVER WAIT
+
 
 class Configuration(Mapping):
+    """
+    EVERY CHANGE BUILDS A NEW _Version, AND PUBLISHES IT BY REPLACING ONE
+    REFERENCE, SO A READER SEES ALL OF A CHANGE, OR NONE OF IT
+
+    A CHILD (eg config.db) IS A READ-ONLY VIEW OF ITS PARENT'S STORAGE: CHANGE
+    THE PARENT, OR MAKE AN INDEPENDENT COPY WITH Configuration(config.db)
+    """
+
+    _read_only = False  # True FOR A VIEW
+
     def __init__(self, config, path="."):
         if not isinstance(config, Mapping) and not is_data(config):
             logger.error("Expecting data, not {config}", config=config)
+        if isinstance(config, LazyData):
+            # KEEP THE LazyRef, RESOLVE WHEN READ
+            config = config._data
         self._path = path
-        self._lookup = leaves_to_data({join_field(wordify(path)): value for path, value in Data(**config).leaves()})
+        self._version = _Version(leaves_to_data({_normalize(path): value for path, value in Data(**config).leaves()}))
+
+    @property
+    def _lookup(self):
+        return self._version.lookup
 
     def __iter__(self):
         return (k for k, _ in self._lookup.leaves())
@@ -27,58 +65,498 @@ class Configuration(Mapping):
     def __len__(self):
         return len(self._lookup)
 
+    def snapshot(self):
+        """
+        :return: Configuration THAT IS NOT CHANGED BY LATER CHANGES TO self (NOTHING IS COPIED)
+        """
+        output = object.__new__(self.__class__)
+        output.__dict__.update(self.__dict__)
+        return output
+
     def clear(self):
-        self._lookup = Data()
-        return self
+        return self._publish(lambda version: _Version(Data()))
+
+    def replace(self, other):
+        """
+        ALL OF other, AND NOTHING ELSE, AS ONE CHANGE (A clear() THEN append() SHOWS READERS NOTHING IN BETWEEN)
+        """
+        lookup = Configuration(other)._lookup
+        return self._publish(lambda version: _Version(lookup))
 
     def prepend(self, other):
         """
         RECURSIVE COALESCE OF PROPERTIES, BUT WITH other TAKING HIGH PRIORITY
         """
-        self._lookup = Configuration(other)._lookup | self._lookup
-        return self
+        lookup = Configuration(other)._lookup
+        return self._publish(lambda version: _Version(lookup | version.lookup))
 
     def append(self, other):
         """
         RECURSIVE COALESCE OF PROPERTIES
         """
-        self._lookup |= Configuration(other)._lookup
-        return self
+        lookup = Configuration(other)._lookup
+        return self._publish(lambda version: _Version(version.lookup | lookup))
 
     def __iadd__(self, other):
         """
         RECURSIVE ACCUMULATION OF PROPERTIES
         """
-        self._lookup += Configuration(other)._lookup
-        return self
+        lookup = Configuration(other)._lookup
+        return self._publish(lambda version: _Version(_add(version.lookup, lookup)))
 
     def __ior__(self, other):
         """
         RECURSIVE COALESCE OF PROPERTIES
         """
-        self._lookup |= Configuration(other)._lookup
+        return self.append(other)
+
+    def _publish(self, change):
+        """
+        :param change: FUNCTION FROM THE CURRENT _Version TO THE NEXT, WHICH MUST NOT CHANGE THE CURRENT ONE
+        """
+        self._check_writable()
+        with _writing:
+            self._version = change(self._version)
         return self
 
+    def _check_writable(self):
+        if self._read_only:
+            logger.error(
+                "Configuration {path|quote} is a view of its parent, change the parent instead", path=self._path
+            )
+
     def __or__(self, other):
         output = Configuration(other, self._path)
         output.lookup = self._lookup | output._lookup
         return output
 
     def __getattr__(self, item):
-        clean_path = join_field(wordify(item))
-        value = self._lookup[clean_path]
-        if value == None:
+        # ONE _Version FOR THE WHOLE READ, SO A CHANGE IN THE MIDDLE IS NOT SEEN
+        version = self._version
+        key = self._path, item
+        try:
+            return version.cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # UNHASHABLE item
+            return self._get(item, version)
+        value = self._get(item, version)
+        if not isinstance(value, LazyList):
+            version.cache[key] = value
+        return value
+
+    __getitem__ = __getattr__
+
+    def accessor(self, path):
+        """
+        :param path: DOT-DELIMITED PATH, eg "db.primary.host"
+        :return: FUNCTION THAT RETURNS THE VALUE AT path, WITHOUT PARSING path AGAIN
+        """
+        steps = split_field(_normalize(path))
+
+        def accessor():
+            value = self
+            for step in steps:
+                value = value[step]
+            return value
+
+        return accessor
+
+    def _get(self, item, version):
+        value = self._find(item, version)
+        if value is None:
             logger.error(
-                "Expecting configuration {path|quote}", path=concat_field(self._path, clean_path), stack_depth=1,
+                "Expecting configuration {path|quote}", path=concat_field(self._path, _normalize(item)), stack_depth=2,
             )
+        return value
+
+    def _find(self, item, version):
+        """
+        :return: THE VALUE OF item IN version, OR None IF MISSING
+        """
+        clean_path = _normalize(item)
+        lookup = version.lookup
+        value = lookup[clean_path]
+        if isinstance(value, LazyRef):
+            # THE ONLY CHANGE TO A PUBLISHED _Version: THE SAME VALUE, NO MATTER WHO RESOLVES IT
+            value = value.resolve()
+            lookup[clean_path] = Configuration(value)._lookup if is_data(value) else value
+            value = lookup[clean_path]
+        if value == None:
+            return None
         if is_data(value):
-            return Configuration(value, concat_field(self._path, clean_path))
+            return self._view(value, concat_field(self._path, clean_path), version)
+        if is_list(value) and any(isinstance(v, LazyRef) for v in value):
+            return LazyList(value)
         return value
 
-    __getitem__ = __getattr__
+    def freeze(self):
+        """
+        :return: FrozenConfiguration OF THIS (LazyRef ARE RESOLVED NOW)
+        """
+        return FrozenConfiguration(self)
+
+    def _view(self, lookup, path, version):
+        """
+        :return: Configuration OF lookup, WHICH IS ALREADY NORMALIZED, AND SHARED WITH version
+        """
+        output = object.__new__(Configuration)
+        output._path = path
+        output._version = _Version(lookup, cache=version.cache)
+        output._read_only = True
+        return output
 
     def __repr__(self):
         return f"Configuration({from_data(self._lookup)})"
 
 
+class LayeredConfiguration(Configuration):
+    """
+    A STACK OF CONFIGURATIONS, LOWEST PRIORITY FIRST. EACH LAYER IS KEPT AS
+    IT IS, AND A READ IS ANSWERED BY THE HIGHEST LAYER WITH THE KEY (NESTED
+    OBJECTS ARE MERGED, LAYER BY LAYER, ONLY WHEN READ)
+
+    A Configuration LAYER IS KEPT AS IT WAS WHEN ADDED (A snapshot(), NOT A
+    COPY); CHANGES MADE TO IT AFTERWARDS ARE NOT SEEN, SO pop() AND push() IT AGAIN
+    """
+
+    def __init__(self, *layers):
+        """
+        :param layers: LOWEST PRIORITY FIRST, eg defaults, file, environment, command line
+        """
+        self._path = "."
+        self._version = _Version(None, tuple(_layer(layer) for layer in layers))
+
+    @property
+    def layers(self):
+        return list(self._version.layers)
+
+    @property
+    def _lookup(self):
+        # ONLY FOR ITERATION AND repr, SO BUILT WHEN ASKED
+        version = self._version
+        if version.lookup is None:
+            merged = Data()
+            for layer in reversed(version.layers):
+                merged |= layer._lookup
+            version.lookup = merged
+        return version.lookup
+
+    def push(self, layer):
+        """
+        ADD layer ON TOP, WITH THE HIGHEST PRIORITY
+        """
+        layer = _layer(layer)
+        return self._publish(lambda version: _Version(None, version.layers + (layer,)))
+
+    def pop(self):
+        """
+        :return: THE TOP LAYER, REMOVED
+        """
+        self._check_writable()
+        with _writing:
+            layers = self._version.layers
+            output = layers[-1]
+            self._version = _Version(None, layers[:-1])
+        return output
+
+    prepend = push
+
+    def append(self, other):
+        """
+        ADD other UNDER ALL LAYERS, WITH THE LOWEST PRIORITY
+        """
+        layer = _layer(other)
+        return self._publish(lambda version: _Version(None, (layer,) + version.layers))
+
+    __ior__ = append
+
+    def __iadd__(self, other):
+        logger.error("Layers can not be accumulated, use Configuration")
+
+    def clear(self):
+        return self._publish(lambda version: _Version(None, ()))
+
+    def replace(self, other):
+        layer = _layer(other)
+        return self._publish(lambda version: _Version(None, (layer,)))
+
+    def _find(self, item, version):
+        found = []
+        for layer in reversed(version.layers):
+            value = layer._find(item, layer._version)
+            if value is None:
+                continue
+            if not isinstance(value, Configuration):
+                if found:
+                    # AN OBJECT ABOVE HIDES THIS VALUE
+                    break
+                return value
+            found.append(value)
+        if not found:
+            return None
+        if len(found) == 1:
+            return found[0]
+        output = object.__new__(LayeredConfiguration)
+        output._path = concat_field(self._path, _normalize(item))
+        output._version = _Version(None, tuple(reversed(found)), version.cache)
+        output._read_only = True
+        return output
+
+    def __repr__(self):
+        return f"LayeredConfiguration({len(self._version.layers)} layers)"
+
+
+class _Version:
+    """
+    WHAT A Configuration READS. ONCE PUBLISHED, IT IS NOT CHANGED (EXCEPT TO
+    REMEMBER WHAT IS BUILT WHEN READ), A WRITER PUBLISHES A NEW ONE INSTEAD
+    """
+
+    __slots__ = ["lookup", "layers", "cache"]
+
+    def __init__(self, lookup, layers=None, cache=None):
+        self.lookup = lookup  # NORMALIZED Data (MERGED layers, BUILT WHEN ASKED, FOR LayeredConfiguration)
+        self.layers = layers  # tuple OF Configuration, LOWEST PRIORITY FIRST, FOR LayeredConfiguration
+        # MAP FROM (path, item) TO WHAT __getattr__ RETURNED, SHARED WITH THE CHILD VIEWS
+        self.cache = {} if cache is None else cache
+
+
+def _add(lookup, other):
+    """
+    :return: lookup + other, WITHOUT CHANGING lookup
+    """
+    output = to_data(_copy_reached(from_data(lookup), from_data(other)))
+    output += other
+    return output
+
+
+def _copy_reached(lookup, other):
+    """
+    :return: SHALLOW COPY OF lookup, WITH A COPY OF EVERY dict AND list THAT other ADDS TO
+    """
+    output = dict(lookup)
+    for name, value in other.items():
+        found = output.get(name)
+        if isinstance(found, dict) and isinstance(value, dict):
+            output[name] = _copy_reached(found, value)
+        elif isinstance(found, list):
+            output[name] = list(found)
+    return output
+
+
+class FrozenConfiguration(Mapping):
+    """
+    IMMUTABLE, HASHABLE, Configuration, IN A FRACTION OF THE MEMORY: EACH
+    OBJECT IS A _Node OF TUPLES (WITH INTERNED NAMES), AND EQUAL OBJECTS AND
+    LISTS ARE STORED ONCE. SAFE TO SHARE ACROSS THREADS
+    """
+
+    __slots__ = ["_node", "_path"]  # _path IS A tuple OF NAMES, JOINED ONLY FOR AN ERROR
+
+    def __init__(self, config):
+        if isinstance(config, FrozenConfiguration):
+            node = config._node
+        else:
+            if not isinstance(config, Configuration):
+                config = Configuration(config)
+            node = _freeze(from_data(config._lookup), {})
+        object.__setattr__(self, "_node", node)
+        object.__setattr__(self, "_path", ())
+
+    def __getattr__(self, item):
+        name = _normalize(item)
+        node = self._node
+        if "." in name:
+            *steps, last = split_field(name)
+            for step in steps:
+                node = node.get(step)
+                if node.__class__ is not _Node:
+                    break
+            else:
+                value = node.get(last)
+        else:
+            value = node.get(name)
+        if node.__class__ is not _Node or value is NOTSET:
+            logger.error("Expecting configuration {path|quote}", path=join_field(self._path + (name,)), stack_depth=1)
+        if value.__class__ is _Node:
+            return _frozen_view(value, self._path + (name,))
+        return value
+
+    __getitem__ = __getattr__
+
+    accessor = Configuration.accessor
+
+    def __iter__(self):
+        # LEAF PATHS, LIKE Configuration
+        stack = [(self._node, None)]
+        while stack:
+            node, path = stack.pop()
+            for name, value in zip(reversed(node.names), reversed(node.values)):
+                stack.append((value, concat_field(path, name) if path else name))
+            while stack and stack[-1][0].__class__ is not _Node:
+                yield stack.pop()[1]
+
+    def __len__(self):
+        # TOP-LEVEL NAMES, LIKE Configuration
+        return len(self._node.names)
+
+    def __hash__(self):
+        return hash(self._node)
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenConfiguration):
+            return self._node == other._node
+        return Mapping.__eq__(self, other)
+
+    def __setattr__(self, key, value):
+        logger.error("FrozenConfiguration can not be changed")
+
+    def __delattr__(self, item):
+        logger.error("FrozenConfiguration can not be changed")
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def freeze(self):
+        return self
+
+    def __repr__(self):
+        return f"FrozenConfiguration({dict(self)})"
+
+
+class _Node:
+    """
+    ONE OBJECT: SORTED NAMES, AND THEIR VALUES
+    """
+
+    __slots__ = ["names", "values", "index", "hash"]
+
+    def __init__(self, names, values):
+        self.names = names
+        self.values = values
+        # A SMALL TUPLE IS SEARCHED FASTER THAN A dict IS BUILT, AND IS SMALLER
+        self.index = dict(zip(names, values)) if len(names) > SMALL_NODE else None
+        self.hash = None
+
+    def get(self, name):
+        if self.index is not None:
+            return self.index.get(name, NOTSET)
+        try:
+            return self.values[self.names.index(name)]
+        except ValueError:
+            return NOTSET
+
+    def __hash__(self):
+        if self.hash is None:
+            self.hash = hash((self.names, self.values))
+        return self.hash
+
+    def __eq__(self, other):
+        return (
+            other.__class__ is _Node
+            and hash(self) == hash(other)
+            and self.names == other.names
+            and self.values == other.values
+        )
+
+
+def _frozen_view(node, path):
+    output = _new(FrozenConfiguration)
+    _set_node(output, node)
+    _set_path(output, path)
+    return output
+
+
+_new = object.__new__
+_set_node = FrozenConfiguration._node.__set__
+_set_path = FrozenConfiguration._path.__set__
+
+
+def _freeze(lookup, memo):
+    """
+    :param lookup: NORMALIZED dict, AS IN Configuration._lookup
+    :param memo: MAP FROM _Build KEY TO THE _Node OR tuple, SO EQUAL ONES ARE SHARED
+    :return: _Node
+    """
+    # EXPLICIT STACK, SO THERE IS NO LIMIT ON THE NESTING DEPTH
+    # (value, target, in_list) - APPEND THE FROZEN value TO target
+    # (_Build, target, in_list) - ALL THE VALUES OF THE _Build ARE FROZEN
+    result = []
+    stack = [(lookup, result, False)]
+    while stack:
+        value, target, in_list = stack.pop()
+        if value.__class__ is _Build:
+            target.append(value.finish(memo, in_list))
+            continue
+        if isinstance(value, LazyRef):
+            value = value.resolve()
+            if is_data(value):
+                value = Configuration(value)._lookup
+        value = from_data(value)
+        if isinstance(value, Mapping):
+            if in_list:
+                # Configuration DOES NOT NORMALIZE THE OBJECTS IN LISTS, BUT WE MUST
+                value = from_data(Configuration(value)._lookup)
+            items = sorted((k, v) for k, v in value.items() if v is not None)
+            build = _Build(tuple(sys.intern(k) for k, _ in items))
+            stack.append((build, target, in_list))
+            stack.extend((v, build.values, False) for _, v in reversed(items))
+        elif isinstance(value, (list, tuple)):
+            build = _Build(None)
+            stack.append((build, target, in_list))
+            stack.extend((v, build.values, True) for v in reversed(value))
+        else:
+            target.append(value)
+    return result[0]
+
+
+class _Build:
+    __slots__ = ["names", "values"]
+
+    def __init__(self, names):
+        self.names = names  # None FOR A LIST
+        self.values = []
+
+    def finish(self, memo, in_list):
+        # THE VALUES ARE ALREADY SHARED, SO THEY ARE COMPARED BY IDENTITY, AND
+        # PRIMITIVES BY TYPE TOO (1 == True == 1.0, BUT THEY ARE NOT THE SAME)
+        key = self.names, tuple(_memo_key(v) for v in self.values)
+        output = memo.get(key)
+        if output is None:
+            if self.names is None:
+                output = tuple(self.values)
+            else:
+                output = _Node(self.names, tuple(self.values))
+            memo[key] = output
+        if in_list and output.__class__ is _Node:
+            return _frozen_view(output, ())
+        return output
+
+
+def _memo_key(value):
+    if value.__class__ in (_Node, tuple):
+        return id(value)
+    if value.__class__ is FrozenConfiguration:
+        return id(value._node)
+    return value.__class__, value
+
+
+def _layer(config):
+    # A snapshot(), SO A LATER CHANGE TO config CAN NOT DISAGREE WITH WHAT THE LAYERS ALREADY ANSWERED
+    return config.snapshot() if isinstance(config, Configuration) else Configuration(config)
+
+
+@lru_cache(maxsize=MAX_KEYS)
+def _normalize(key):
+    # "thisIs_a-TEST" -> "this.is.a.test"
+    return join_field(wordify(key))
+
+
 register_data(Configuration)
+register_data(LayeredConfiguration)
+register_data(FrozenConfiguration)
@@ -0,0 +1,134 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from threading import Lock
+
+from mo_dots import join_field, split_field
+
+from mo_json_config.cache import parse_url
+from mo_json_config.tracing import output_path, redact
+
+
+class DependencyGraph:
+    """
+    A tracer THAT RECORDS WHICH SOURCES EACH PART OF THE OUTPUT CAME FROM
+
+        graph = DependencyGraph()
+        config = expand(doc, tracer=graph)
+        graph.depends_on("database.password")
+        graph.affected_by("file:///etc/app/secrets.json")
+    """
+
+    def __init__(self):
+        self.sources = {}  # MAP FROM OUTPUT PATH TO {source: {"scheme", "fingerprint"}}
+        self.links = {}  # MAP FROM OUTPUT PATH TO THE OUTPUT PATHS ITS INTERNAL REFERENCES POINT TO
+        self._lock = Lock()
+
+    def __call__(self, span):
+        if span.outcome == "error":
+            return
+        # A $default IS USED BECAUSE THE SOURCE IS MISSING, SO THE OUTPUT STILL DEPENDS ON IT
+        path = span.path
+        if span.scheme == "ref":
+            target = _target(span.url.split("#", 1)[1], span._path)
+            if target is not None:
+                with self._lock:
+                    self.links.setdefault(path, set()).add(target)
+            return
+        with self._lock:
+            self.sources.setdefault(path, {})[span.url] = {"scheme": span.scheme, "fingerprint": span.fingerprint}
+
+    def depends_on(self, path="."):
+        """
+        :param path: DOT-DELIMITED PATH INTO THE OUTPUT
+        :return: MAP FROM source TO {"scheme", "fingerprint"} FOR EVERY SOURCE THE path WAS BUILT FROM
+        """
+        output = {}
+        with self._lock:
+            todo, seen = [path], set()
+            while todo:
+                path = todo.pop()
+                if path in seen:
+                    continue
+                seen.add(path)
+                for p, found in self.sources.items():
+                    if _overlaps(p, path):
+                        output.update(found)
+                for p, targets in self.links.items():
+                    if _overlaps(p, path):
+                        todo.extend(targets)
+        return output
+
+    def affected_by(self, source):
+        """
+        :param source: URL OF A FILE, ENVIRONMENT VARIABLE, SSM PATH, ...
+        :return: SORTED OUTPUT PATHS THAT MAY CHANGE IF source CHANGES
+        """
+        # ONLY PART OF A DOCUMENT MAY BE USED (file.json#key), BUT IT IS STILL THE SAME SOURCE
+        source = _document(redact(parse_url(source)))
+        with self._lock:
+            output = {p for p, found in self.sources.items() if any(_document(s) == source for s in found)}
+            while True:
+                more = {
+                    p
+                    for p, targets in self.links.items()
+                    if p not in output and any(_overlaps(t, o) for t in targets for o in output)
+                }
+                if not more:
+                    break
+                output |= more
+        return sorted(output)
+
+    def __data__(self):
+        with self._lock:
+            return {
+                "sources": {p: {s: dict(d) for s, d in found.items()} for p, found in self.sources.items()},
+                "links": {p: sorted(targets) for p, targets in self.links.items()},
+            }
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        :param data: FROM __data__(), POSSIBLY AFTER A TRIP THROUGH JSON
+        """
+        output = cls()
+        output.sources = {p: {s: dict(d) for s, d in found.items()} for p, found in data["sources"].items()}
+        output.links = {p: set(targets) for p, targets in data["links"].items()}
+        return output
+
+
+def _document(source):
+    return source.split("#", 1)[0]
+
+
+def _overlaps(a, b):
+    # ONE PATH IS INSIDE THE OTHER
+    a, b = split_field(a), split_field(b)
+    n = min(len(a), len(b))
+    return a[:n] == b[:n]
+
+
+def _target(frag, path):
+    """
+    :return: OUTPUT PATH THE INTERNAL REFERENCE POINTS TO (SAME WALK AS THE ref LOADER)
+    """
+    if not frag.startswith("."):
+        return frag
+    doc = (None, path)
+    for i, c in enumerate(frag):
+        if c != ".":
+            break
+        if not isinstance(doc, tuple):
+            return None
+        doc = doc[1]
+    else:
+        return None
+    if not isinstance(doc, tuple):
+        return None
+    return join_field(split_field(output_path(doc)) + split_field(frag[i:]))
@@ -1,41 +1,136 @@
 import re
+from contextvars import ContextVar
+from copy import copy
 
-from mo_dots import is_data, is_list, set_default, from_data, is_sequence, coalesce, is_missing
+from mo_dots import is_data, is_list, set_default, from_data, is_sequence, coalesce, is_missing, get_attr
 from mo_files.url import URL
 from mo_logs import logger
 
-from mo_json_config.schemes import scheme_loaders
+from mo_json_config.cache import parse_url, remote_cache
+from mo_json_config.lazy import LazyRef, resolved
+from mo_json_config.registry import scheme_loaders
+from mo_json_config.tracing import call_loader
 
 DEBUG = False
 NOTSET = {}
 
+# MAP FROM id(node) TO (node, output) FOR NODES ALREADY EXPANDED
+_finished = ContextVar("finished", default=None)
+# MAP FROM id(node) TO node, FOR FIRST PHASE OUTPUT THAT NEEDS NOTHING MORE
+_done = ContextVar("done", default=None)
+# MAP FROM (id(document), fragment) TO (document, output) FOR ABSOLUTE REFERENCES ALREADY EXPANDED
+_fragments = ContextVar("fragments", default=None)
+# THE [key, fragment, can_memoize] OF THE REFERENCES BEING EXPANDED, OUTERMOST FIRST
+_resolving = ContextVar("resolving", default=())
+
 
 def _replace_locals(path, url):
-    node, parent = path
-    if is_data(node):
-        for op, func in operators.items():
-            if op in node:
-                return func(node, path, url)
-        return _replace_data(node, path, url)
-    elif is_list(node):
-        return [_replace_locals((n, path), url) for n in node]
-    elif isinstance(node, str):
-        return _replace_str(node, parent, url)
-    return node
-
-
-def _replace_data(node, path, url):
-    output = {}
-    for k, v in node.items():
-        if is_missing(v) or k in operators:
-            continue
-        output[k] = _replace_locals((v, path), url)
+    """
+    AN EXPLICIT STACK IS USED, SO THERE IS NO LIMIT ON THE NESTING DEPTH
+    """
+    done = _done.get()
+    finished = _finished.get()
+    result = []
+    # (path, target, key) - PUT THE OUTPUT FOR path INTO target[key], OR APPEND IF key IS None
+    stack = [(path, result, None)]
+    while stack:
+        path, target, key = stack.pop()
+        node, parent = path
+        children = None
+        if done is not None and id(node) in done:
+            output = node
+        elif finished is not None and id(node) in finished:
+            output = _copy(finished[id(node)][1])
+        elif is_data(node):
+            for op, func in operators.items():
+                if op in node:
+                    output = func(node, path, url)
+                    break
+            else:
+                output = {}
+                children = [
+                    ((v, path), output, k)
+                    for k, v in reversed(list(node.items()))
+                    if not is_missing(v) and k not in operators
+                ]
+        elif is_list(node):
+            output = []
+            children = [((n, path), output, None) for n in reversed(node)]
+        elif isinstance(node, str):
+            output = _replace_str(node, parent, url)
+        elif isinstance(node, LazyRef):
+            _depends_on_path()
+            output = node.bind(parent, url)
+        else:
+            output = node
+
+        if key is None:
+            target.append(output)
+        else:
+            target[key] = output
+        if children:
+            stack.extend(children)
+    return result[0]
+
+
+def _replace_fragment(doc, frag, ref, path, url):
+    """
+    EXPAND THE PART OF doc AT frag
+    :param doc: NODE IN THE FIRST PHASE OUTPUT THE frag STARTS FROM
+    :param frag: PATH INTO doc (WITHOUT THE LEADING DOTS)
+    :param ref: THE REFERENCE, FOR ERROR MESSAGES
+    :param path: PATH OF THE REFERENCE
+    """
+    is_relative = ref.fragment.startswith(".")
+    key = id(doc), frag
+    chain = _resolving.get()
+    for i, (k, _, _) in enumerate(chain):
+        if k == key:
+            loop = [f for _, f, _ in chain[i:]] + [chain[i][1]]
+            logger.error("reference cycle {cycle}", cycle=" -> ".join(loop))
+    if is_relative:
+        # THE OUTPUT OF THE REFERENCES WE ARE IN DEPENDS ON WHERE THEY WERE MADE
+        _depends_on_path()
+
+    fragments = _fragments.get()
+    if fragments is not None and not is_relative:
+        found = fragments.get(key)
+        if found is not None:
+            return _copy(found[1])
+
+    frame = [key, "#" + ref.fragment, True]
+    token = _resolving.set(chain + (frame,))
+    try:
+        output = resolved(_replace_locals((get_attr(doc, frag), path), url))
+    finally:
+        _resolving.reset(token)
+    if fragments is not None and frame[2] and not is_relative:
+        fragments[key] = doc, _copy(output)
     return output
 
 
+def _depends_on_path():
+    for frame in _resolving.get():
+        frame[2] = False
+
+
 def _replace_ref(ref_node, path, url):
-    ref = URL(_replace_str(str(ref_node["$ref"]), path, url))
-    new_value = scheme_loaders["ref"](ref, path, url)
+    # THE OUTPUT IS MERGED IN PLACE, SO IT MUST NOT SHARE ANYTHING WITH THE DOCUMENT
+    token = _done.set(None)
+    try:
+        return _replace_ref_copy(ref_node, path, url)
+    finally:
+        _done.reset(token)
+
+
+def _replace_ref_copy(ref_node, path, url):
+    raw_ref = ref_node["$ref"]
+    if isinstance(raw_ref, URL):
+        # LEFT BY THE FIRST PHASE
+        ref = copy(raw_ref)
+    else:
+        ref = parse_url(_replace_str(str(raw_ref), path, url))
+    new_value = call_loader(scheme_loaders["ref"], ref, path, url)
     defaults = _replace_default(ref_node, path, url)
 
     output = {}
@@ -61,7 +156,7 @@ def _replace_default(node, path, url):
     defaults = node.get("$default", NOTSET)
     if defaults is NOTSET:
         return NOTSET
-    return _replace_locals((node["$default"], path), url)
+    return resolved(_replace_locals((node["$default"], path), url))
 
 
 def _replace_concat(node, path, url):
@@ -69,31 +164,129 @@ def _replace_concat(node, path, url):
     v = node.get("$concat")
     if not is_sequence(v):
         logger.error("$concat expects an array of strings")
-    return coalesce(node.get("separator"), "").join(_replace_locals((vv, path), url) for vv in v)
+    return coalesce(node.get("separator"), "").join(resolved(_replace_locals((vv, path), url)) for vv in v)
 
 
 is_url = re.compile(r"\{([0-9a-zA-Z]+://[^}]*)}")
 
 
+MAX_TEMPLATES = 10_000
+# MAP FROM text TO None (NO TEMPLATE) OR (literal, ref, literal, ..., ref, literal)
+_templates = {}
+
+
+def _parse_template(text):
+    """
+    :return: None IF text HAS NO TEMPLATE, OR THE ALTERNATING LITERALS AND REFS
+    """
+    if "://" not in text:
+        return None
+    template = _templates.get(text, NOTSET)
+    if template is NOTSET:
+        parts = is_url.split(text)
+        template = tuple(parts) if len(parts) > 1 else None
+        if len(_templates) >= MAX_TEMPLATES:
+            _templates.clear()
+        _templates[text] = template
+    return template
+
+
 def _replace_str(text, path, url):
-    acc = []
-    end = 0
-    for found in is_url.finditer(text):
-        acc.append(text[end  : found.start()])
+    template = _parse_template(text)
+    if template is None:
+        return text
+    acc = [template[0]]
+    for i in range(1, len(template), 2):
+        raw_ref = template[i]
         try:
-            ref = URL(found.group(1))
+            ref = parse_url(raw_ref)
             if ref.scheme not in scheme_loaders:
                 raise logger.error("unknown protocol {ref}", ref=ref)
-            value = scheme_loaders[ref.scheme](ref, path, url)
+            value = call_loader(remote_cache.loader(ref.scheme), ref, path, url)
             if is_missing(value):
                 raise logger.error("value not found {ref}", ref=ref)
             acc.append(value)
         except Exception as cause:
-            raise logger.error("problem replacing {ref}", ref=found.group(1), cause=cause)
-        end = found.end()
-    if end == 0:
-        return text
-    return "".join(acc) + text[end:]
+            raise logger.error("problem replacing {ref}", ref=raw_ref, cause=cause)
+        acc.append(template[i + 1])
+    return "".join(acc)
+
+
+_atoms = (int, float, bool, type(None))
+
+
+def _is_done(value, done):
+    """
+    :return: True IF THE SECOND PHASE WOULD ONLY COPY value
+    """
+    cls = value.__class__
+    if cls in _atoms:
+        return True
+    elif cls is str:
+        return _parse_template(value) is None
+    elif cls is dict or cls is list:
+        return id(value) in done
+    return not is_data(value) and not is_list(value) and not isinstance(value, LazyRef)
+
+
+def _mark_done(output, done):
+    """
+    MARK output (A dict OR list) AS DONE IF ALL ITS CHILDREN ARE
+    """
+    if output.__class__ is dict:
+        if any(op in output for op in operators):
+            return
+        for v in output.values():
+            if is_missing(v) or not _is_done(v, done):
+                return
+    else:
+        for v in output:
+            if not _is_done(v, done):
+                return
+    done[id(output)] = output
+
+
+def _check_done(value, done):
+    """
+    MARK value AGAIN, AFTER MERGING MAY HAVE CHANGED ITS PARTS
+    """
+    # CHILDREN ARE MARKED BEFORE PARENTS, SO VISIT PARENTS FIRST, AND MARK IN REVERSE
+    todo = [from_data(value)]
+    containers = []
+    while todo:
+        value = todo.pop()
+        if is_data(value):
+            todo.extend(from_data(v) for v in value.values())
+        elif is_list(value):
+            todo.extend(from_data(v) for v in value)
+        else:
+            continue
+        done.pop(id(value), None)
+        if value.__class__ is dict or value.__class__ is list:
+            containers.append(value)
+    for value in reversed(containers):
+        _mark_done(value, done)
+
+
+def _copy(value):
+    # OUTPUT IS ONLY dict, list AND PRIMITIVES
+    result = []
+    stack = [(value, result, None)]
+    while stack:
+        value, target, key = stack.pop()
+        if value.__class__ is dict:
+            output = {}
+            stack.extend((v, output, k) for k, v in reversed(list(value.items())))
+        elif value.__class__ is list:
+            output = []
+            stack.extend((v, output, None) for v in reversed(value))
+        else:
+            output = value
+        if key is None:
+            target.append(output)
+        else:
+            target[key] = output
+    return result[0]
 
 
 operators = {
@@ -7,28 +7,48 @@
 #
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
+from contextvars import copy_context
 
 from mo_dots import is_data, is_list, set_default, to_data, get_attr, listwrap, unwraplist
 from mo_files import File
 from mo_files.url import URL
+from mo_imports import delay_import
 from mo_logs import Except, logger, get_stacktrace
 
-from mo_json_config.expand_locals import _replace_locals, _replace_str
-from mo_json_config.schemes import scheme_loaders
+from mo_json_config.cache import parse_url
+from mo_json_config.dependencies import DependencyGraph
+from mo_json_config.expand_locals import _check_done, _done, _fragments, _mark_done, _replace_locals, _replace_str
+from mo_json_config.lazy import LazyData, LazyRef, _lazy, resolved
+from mo_json_config.prefetch import AsyncPrefetch, Prefetch, _load, prefetch_foreign_refs
+from mo_json_config.registry import scheme_loaders
+from mo_json_config.tracing import _tracer, redact, tee, tracing
+
+asyncio = delay_import("asyncio")
 
 NOTSET = {}
 LOOKBACK = 1
 
 
-def get(url):
+def get(url, max_workers=None, lazy=False, tracer=None, snapshot=None):
     caller = URL("file://" + File(get_stacktrace(start=LOOKBACK)[0]["file"]).abs_path)
-    return expand(to_data({"$ref": url}), doc_url=caller)
+    return expand(
+        to_data({"$ref": url}), doc_url=caller, max_workers=max_workers, lazy=lazy, tracer=tracer, snapshot=snapshot
+    )
 
 
 get_file = get
 
 
-def expand(doc, doc_url="param://", params=None):
+def get_async(url, max_workers=None, tracer=None):
+    """
+    NOT async ITSELF, SO THE CALLER IS FOUND NOW, NOT WHEN THE COROUTINE FIRST RUNS
+    :return: COROUTINE OF THE EXPANDED DOCUMENT
+    """
+    caller = URL("file://" + File(get_stacktrace(start=LOOKBACK)[0]["file"]).abs_path)
+    return expand_async(to_data({"$ref": url}), doc_url=caller, max_workers=max_workers, tracer=tracer)
+
+
+def expand(doc, doc_url="param://", params=None, max_workers=None, lazy=False, tracer=None, snapshot=None):
     """
     ASSUMING YOU ALREADY PULLED THE doc FROM doc_url, YOU CAN STILL USE THE
     EXPANDING FEATURE
@@ -38,43 +58,153 @@ def expand(doc, doc_url="param://", params=None):
     :param doc: THE DATA STRUCTURE FROM JSON SOURCE
     :param doc_url: THE URL THIS doc CAME FROM (DEFAULT USES params AS A DOCUMENT SOURCE)
     :param params: EXTRA PARAMETERS NOT FOUND IN THE doc_url PARAMETERS (WILL SUPERSEDE PARAMETERS FROM doc_url)
-    :return: EXPANDED JSON-SERIALIZABLE STRUCTURE
+    :param max_workers: FETCH FOREIGN REFERENCES CONCURRENTLY WITH THIS MANY THREADS
+    :param lazy: LOAD FOREIGN REFERENCES ONLY WHEN FIRST READ (max_workers IS IGNORED)
+    :param tracer: CALLED WITH A tracing.Span AFTER EVERY SCHEME LOADER CALL
+    :param snapshot: snapshot.SnapshotCache TO SKIP THE EXPANSION IF NO SOURCE HAS CHANGED (IGNORED IF lazy)
+    :return: EXPANDED JSON-SERIALIZABLE STRUCTURE (LazyData IF lazy)
+    """
+    url = _doc_url(doc_url, params)
+    with tracing(tracer):
+        if lazy:
+            token = _lazy.set(True)
+            try:
+                return LazyData(resolved(_expand_phases(doc, url)))
+            finally:
+                _lazy.reset(token)
+        if snapshot is not None:
+            return _expand_snapshot(snapshot, doc, url, max_workers)
+        return _expand_workers(doc, url, max_workers)
+
+
+def _expand_workers(doc, url, max_workers):
+    if max_workers:
+        with Prefetch(max_workers):
+            return _expand(doc, url)
+    return _expand(doc, url)
+
+
+def _expand_snapshot(snapshot, doc, url, max_workers):
+    found = snapshot.load(doc, url)
+    if found is not None:
+        return to_data(found)
+    # THE GRAPH HAS THE SOURCES, TO CHECK NEXT TIME
+    graph = DependencyGraph()
+    with tracing(tee(_tracer.get(), graph)):
+        output = _expand_workers(doc, url, max_workers)
+    snapshot.save(doc, url, graph, output)
+    return output
+
+
+async def expand_async(doc, doc_url="param://", params=None, max_workers=None, tracer=None):
+    """
+    SAME AS expand(), BUT FOREIGN REFERENCES ARE LOADED CONCURRENTLY: WITH
+    async_scheme_loaders ON THIS EVENT LOOP, OR WITH scheme_loaders ON THREADS
+
+    :param max_workers: NUMBER OF THREADS FOR THE SYNC LOADERS (DEFAULT FROM ThreadPoolExecutor)
     """
+    url = _doc_url(doc_url, params)
+    loop = asyncio.get_running_loop()
+    with tracing(tracer), AsyncPrefetch(loop, max_workers):
+        # THE WALK ITSELF BLOCKS, SO IT DOES NOT RUN ON THE EVENT LOOP
+        return await loop.run_in_executor(None, copy_context().run, _expand, doc, url)
+
+
+def _doc_url(doc_url, params):
     url = URL(doc_url)
     if not url.scheme:
         logger.error("{url} must have a protocol (eg https://) declared", url=doc_url)
-
     url.query = set_default(params, url.query)
-    phase1 = _replace_foreign_ref((doc, None), url)  # BLANK URL ONLY WORKS IF url IS ABSOLUTE
-    phase2 = _replace_locals((phase1, None), url)
-    return to_data(phase2)
+    return url
+
+
+def _expand(doc, url):
+    prefetch_foreign_refs((doc, None), url)
+    return to_data(_expand_phases(doc, url))
+
+
+def _expand_phases(doc, url):
+    # THE FIRST PHASE MARKS WHAT IS DONE, SO THE SECOND ONLY VISITS WHAT NEEDS THE WHOLE DOCUMENT
+    token = _done.set({})
+    fragments_token = _fragments.set({})
+    try:
+        phase1 = _replace_foreign_ref((doc, None), url)  # BLANK URL ONLY WORKS IF url IS ABSOLUTE
+        return _replace_locals((phase1, None), url)
+    except Except:
+        raise
+    except Exception as cause:
+        # AN INVALID DOCUMENT CAN FAIL DEEP IN mo_dots, SO THE CALLER ALWAYS GETS AN Except
+        logger.error("problem expanding {url}", url=redact(url), cause=cause)
+    finally:
+        _fragments.reset(fragments_token)
+        _done.reset(token)
 
 
 def _replace_foreign_ref(path, url):
     """
-    RECURSIVELY REPLACE FOREIGN REFERENCES IN THE DATA STRUCTURE
-    :param path:
+    REPLACE FOREIGN REFERENCES IN THE DATA STRUCTURE
+    AN EXPLICIT STACK IS USED, SO THERE IS NO LIMIT ON THE NESTING DEPTH
+    :param path: (node, parent_path)
     :param url:
     :return:
     """
     if url.path.endswith("/"):
         url.path = url.path[:-1]
 
-    node, _ = path
-    if is_list(node):
-        output = [_replace_foreign_ref((n, path), url) for n in node]
-        return output
-    elif not is_data(node):
-        return node
+    done = _done.get()
+    lazy = _lazy.get()
+    result = []
+    # (path, target, key) - PUT THE OUTPUT FOR path INTO target[key], OR APPEND IF key IS None
+    # (output, None, None) - ALL CHILDREN OF output ARE FINISHED
+    stack = [(path, result, None)]
+    while stack:
+        path, target, key = stack.pop()
+        if target is None:
+            if done is not None:
+                _mark_done(path, done)
+            continue
 
-    if "$ref" not in node:
-        output = {}
-        for k, v in node.items():
-            k = _replace_str(k, path, url)
-            output[k] = _replace_foreign_ref((v, path), url)
-        return output
+        node, parent = path
+        children = None
+        if is_list(node):
+            output = []
+            children = [((n, path), output, None) for n in reversed(node)]
+        elif not is_data(node):
+            output = node
+        elif "$ref" not in node:
+            output = {}
+            children = [((v, path), output, k) for k, v in reversed(list(node.items()))]
+        elif lazy and not str(node["$ref"]).startswith("#"):
+            output = LazyRef(path, url)
+        else:
+            output = _replace_ref_object(path, url)
 
-    refs = URL(_replace_str(str(node["$ref"]), path, url))
+        if key is None:
+            target.append(output)
+        else:
+            target[_replace_str(key, parent, url)] = output
+        if children:
+            stack.append((output, None, None))
+            stack.extend(children)
+        elif children is not None and done is not None:
+            done[id(output)] = output
+    return result[0]
+
+
+def _replace_ref_object(path, url):
+    """
+    LOAD THE FOREIGN REFERENCES OF A ref-object, AND MERGE WITH ITS PROPERTIES
+    """
+    output = _load_ref_object(path, url)
+    done = _done.get()
+    if done is not None:
+        _check_done(output, done)
+    return output
+
+
+def _load_ref_object(path, url):
+    node, _ = path
+    refs = parse_url(_replace_str(str(node["$ref"]), path, url))
     if "$default" in node:
         defaults = _replace_foreign_ref((node["$default"], path), url)
     else:
@@ -110,7 +240,7 @@ def _replace_foreign_ref(path, url):
         if ref.scheme not in scheme_loaders:
             raise logger.error("unknown protocol {scheme}", scheme=ref.scheme)
         try:
-            new_value = scheme_loaders[ref.scheme](ref, (node, path), url)
+            new_value = _load(ref, (node, path), url)
             ref_found = True
         except Exception as cause:
             ref_error = Except.wrap(cause)
@@ -0,0 +1,126 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from threading import Lock
+
+from mo_dots import from_data
+from mo_imports import delay_import
+from mo_json import json2value
+from mo_logs import logger
+
+from mo_json_config.cache import DocumentCache, NOTSET, _url_path, url_key
+from mo_json_config.tracing import record, redact
+
+requests = delay_import("requests")
+HTTPAdapter = delay_import("requests.adapters.HTTPAdapter")
+make_headers = delay_import("urllib3.util.make_headers")
+_copy = delay_import("mo_json_config.expand_locals._copy")
+
+CONNECT_TIMEOUT_SECONDS = 5
+READ_TIMEOUT_SECONDS = 30
+MAX_BYTES = 16 * 1024 * 1024  # LARGEST (DECOMPRESSED) RESPONSE ACCEPTED
+POOL_SIZE = 16  # KEEP-ALIVE CONNECTIONS PER HOST
+CHUNK_BYTES = 64 * 1024
+
+# PARSED RESPONSES, WITH THEIR (ETag, Last-Modified), TO ASK THE SERVER IF THEY CHANGED
+http_cache = DocumentCache(normalize=_url_path)
+
+_session = None
+_session_lock = Lock()
+
+
+def get_http(ref, doc_path, url):
+    params = url.query
+    key = url_key(ref, params)
+    found = http_cache.peek(key)
+    headers = {}
+    if found is not NOTSET:
+        (etag, last_modified), _ = found
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    response = session().get(
+        str(ref), headers=headers, timeout=(CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS), stream=True
+    )
+    with response:
+        if response.status_code == 304 and found is not NOTSET:
+            (etag, last_modified), value = found
+            record(cache_hit=True, fingerprint=etag or last_modified)
+            return _copy(value)
+        if not 200 <= response.status_code < 300:
+            logger.error("Expecting success from {url}, not {status}", url=redact(ref), status=response.status_code)
+        content = _read(ref, response)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+
+    fingerprint = etag or last_modified
+    record(bytes_read=len(content), cache_hit=False if fingerprint else None, fingerprint=fingerprint)
+    text = content.decode(_charset(response))
+    new_value = from_data(json2value(text, params=params, flexible=True, leaves=True))
+    if fingerprint:
+        http_cache.set(key, (etag, last_modified), new_value, len(content))
+        return _copy(new_value)
+    return new_value
+
+
+def session():
+    """
+    :return: THE requests.Session SHARED BY ALL LOADS, SO CONNECTIONS ARE KEPT ALIVE
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                new_session = requests.Session()
+                # gzip, deflate, AND br IF brotli IS INSTALLED
+                new_session.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                new_session.mount("http://", adapter)
+                new_session.mount("https://", adapter)
+                _session = new_session
+    return _session
+
+
+def close():
+    """
+    CLOSE THE KEPT-ALIVE CONNECTIONS, AND FORGET THE RESPONSES
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+    http_cache.invalidate()
+
+
+def _charset(response):
+    # JSON IS utf8 UNLESS SAID OTHERWISE, DO NOT LET requests GUESS
+    _, _, charset = response.headers.get("Content-Type", "").partition("charset=")
+    return charset.split(";")[0].strip().strip('"') or "utf8"
+
+
+def _read(ref, response):
+    """
+    READ IN CHUNKS, SO A BODY LARGER THAN MAX_BYTES IS AN ERROR BEFORE IT IS ALL
+    IN MEMORY. THE PARSER NEEDS THE WHOLE TEXT, SO IT IS NOT STREAMED INTO IT
+    :return: THE DECOMPRESSED BODY, NO LARGER THAN MAX_BYTES
+    """
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > MAX_BYTES and not response.headers.get("Content-Encoding"):
+        logger.error("{url} is larger than {max} bytes", url=redact(ref), max=MAX_BYTES)
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(CHUNK_BYTES):
+        size += len(chunk)
+        if size > MAX_BYTES:
+            logger.error("{url} is larger than {max} bytes", url=redact(ref), max=MAX_BYTES)
+        chunks.append(chunk)
+    return b"".join(chunks)
@@ -0,0 +1,191 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from collections.abc import Mapping, Sequence
+from contextvars import ContextVar
+from threading import Lock
+
+from mo_dots import Null, from_data, is_data, is_list, split_field
+from mo_imports import delay_import
+from mo_logs import Except, logger
+
+from mo_json_config.tracing import _tracer, redact, tracing
+
+_replace_ref_object = delay_import("mo_json_config.expander._replace_ref_object")
+_replace_locals = delay_import("mo_json_config.expand_locals._replace_locals")
+
+NOTSET = {}
+
+# WHEN SET, FOREIGN ref-objects ARE NOT LOADED, BUT LEFT AS LazyRef
+_lazy = ContextVar("lazy", default=False)
+# THE _phase1 (BY id) OF THE LazyRef BEING RESOLVED, AND OF THOSE THEY ARE INSIDE
+_within = ContextVar("within", default=frozenset())
+
+
+class LazyRef:
+    """
+    A FOREIGN ref-object THAT IS LOADED, MERGED WITH ITS PROPERTIES AND
+    $default, ONLY WHEN FIRST READ
+    """
+
+    __slots__ = ["_path", "_url", "_parent", "_doc_url", "_phase1", "_within", "_value", "_lock", "_tracer"]
+
+    def __init__(self, path, url, parent=None, doc_url=None, phase1=None, tracer=None, within=frozenset()):
+        self._path = path  # (ref-object, parent) IN THE ORIGINAL DOCUMENT
+        self._url = url  # OF THE FILE THE ref-object IS IN, FOR THE FIRST PHASE
+        self._parent = parent  # PATH TO THIS IN THE FIRST PHASE OUTPUT
+        self._doc_url = doc_url or url  # OF THE WHOLE DOCUMENT (AND ITS PARAMETERS), FOR THE SECOND PHASE
+        self._phase1 = phase1 or [NOTSET, Lock()]  # SHARED BY ALL BOUND COPIES
+        self._within = within  # _within WHEN BOUND: IF IT HOLDS OUR OWN _phase1, WE ARE INSIDE OURSELVES
+        self._value = NOTSET
+        self._lock = Lock()
+        self._tracer = tracer or _tracer.get()  # LOADED AFTER expand() RETURNS, SO KEEP IT
+
+    def bind(self, parent, doc_url):
+        """
+        :return: COPY FOR THE GIVEN LOCATION IN THE DOCUMENT
+        """
+        return LazyRef(self._path, self._url, parent, doc_url, self._phase1, self._tracer, _within.get())
+
+    def phase1(self):
+        memo, lock = self._phase1
+        if memo is NOTSET:
+            with lock:
+                memo = self._phase1[0]
+                if memo is NOTSET:
+                    token = _lazy.set(True)
+                    try:
+                        with tracing(self._tracer):
+                            memo = self._phase1[0] = _replace_ref_object(self._path, self._url)
+                    finally:
+                        _lazy.reset(token)
+        return memo
+
+    def resolve(self):
+        """
+        :return: THE EXPANDED VALUE (WHICH MAY HOLD MORE LazyRef)
+        """
+        if self._value is NOTSET:
+            with self._lock:
+                if self._value is NOTSET:
+                    if id(self._phase1) in self._within:
+                        # EAGER EXPANSION FINDS THE SAME CYCLE, BUT LAZY WOULD GO ON FOREVER
+                        logger.error("reference cycle {ref}", ref=str(self._path[0].get("$ref")))
+                    token = _within.set(self._within | {id(self._phase1)})
+                    try:
+                        phase1 = self.phase1()
+                        with tracing(self._tracer):
+                            self._value = resolved(_replace_locals((phase1, self._parent), self._doc_url))
+                    except Except:
+                        raise
+                    except Exception as cause:
+                        # SAME AS _expand_phases(), SO lazy DOES NOT CHANGE THE TYPE OF ERROR
+                        logger.error("problem expanding {url}", url=redact(self._url), cause=cause)
+                    finally:
+                        _within.reset(token)
+        return self._value
+
+    def __getitem__(self, key):
+        # USED BY get_attr() WHEN A LOCAL REFERENCE POINTS INTO THIS
+        return self.phase1()[key]
+
+    def __repr__(self):
+        return f"LazyRef({self._path[0]})"
+
+
+def resolved(value):
+    while isinstance(value, LazyRef):
+        value = value.resolve()
+    return value
+
+
+class LazyData(Mapping):
+    """
+    READ-ONLY VIEW OF A LAZY EXPANSION, RESOLVING LazyRef ON FIRST ACCESS
+    """
+
+    __slots__ = ["_data"]
+
+    def __init__(self, data):
+        # A Data ITERATES OVER ITS ITEMS, NOT ITS KEYS, SO KEEP THE dict
+        object.__setattr__(self, "_data", from_data(data))
+
+    def __getitem__(self, key):
+        if key in self._data:
+            return _wrap(self._data, key)
+        if not isinstance(key, str) or "." not in key:
+            raise KeyError(key)
+        output = self
+        for step in split_field(key):
+            output = output[step]
+        return output
+
+    def __getattr__(self, key):
+        if key in self._data:
+            return _wrap(self._data, key)
+        return Null
+
+    def __setattr__(self, key, value):
+        raise AttributeError("lazy expansion is read-only")
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if not is_data(other) and not isinstance(other, Mapping):
+            return False
+        return dict(self.items()) == dict(other.items())
+
+    def __repr__(self):
+        return f"LazyData({self._data})"
+
+
+class LazyList(Sequence):
+    __slots__ = ["_data"]
+
+    def __init__(self, data):
+        self._data = from_data(data)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [_wrap(self._data, i) for i in range(len(self._data))[index]]
+        # A FlatList GIVES Null PAST ITS END, BUT A Sequence MUST RAISE
+        if index < 0:
+            index += len(self._data)
+        if not 0 <= index < len(self._data):
+            raise IndexError(index)
+        return _wrap(self._data, index)
+
+    def __iter__(self):
+        return (_wrap(self._data, i) for i in range(len(self._data)))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if not is_list(other) and (not isinstance(other, Sequence) or isinstance(other, str)):
+            return False
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"LazyList({self._data})"
+
+
+def _wrap(container, key):
+    value = container[key]
+    if isinstance(value, LazyRef):
+        value = container[key] = value.resolve()
+    if is_data(value):
+        return LazyData(value)
+    elif is_list(value):
+        return LazyList(value)
+    return value
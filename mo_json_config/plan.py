@@ -0,0 +1,218 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from mo_dots import is_data, is_list, set_default, to_data
+
+from mo_json_config.cache import parse_url
+from mo_json_config.expand_locals import _finished, _fragments, _parse_template, _replace_locals, _replace_str, operators
+from mo_json_config.expander import _doc_url, _replace_foreign_ref
+from mo_json_config.tracing import tracing
+
+PARAM_SCHEMES = ("param", "http", "https")  # get_http PARSES WITH THE DOCUMENT PARAMETERS
+CONTEXT_SCHEMES = PARAM_SCHEMES + ("ref",)  # ref MAY POINT TO SOMETHING THAT DEPENDS ON params
+
+
+def compile(doc, doc_url="param://"):
+    """
+    EXPAND WHAT DOES NOT DEPEND ON THE params NOW, SO plan.render(params) IS
+    THE SAME AS expand(doc, doc_url, params), BUT FASTER
+
+    :param doc: THE DATA STRUCTURE FROM JSON SOURCE
+    :param doc_url: THE URL THIS doc CAME FROM
+    :return: Plan
+    """
+    return Plan(doc, _doc_url(doc_url, None))
+
+
+class Plan:
+    def __init__(self, doc, url):
+        self.url = url
+        self.finished = {}  # MAP FROM id(node) TO (node, output), SEE expand_locals._finished
+        dynamic = set()
+        _find_dynamic((doc, None), url, dynamic)
+        self.template = self._compile((doc, None), dynamic)
+
+    def render(self, params=None, tracer=None):
+        """
+        :param params: PARAMETERS FOR THIS EXPANSION (WILL SUPERSEDE PARAMETERS FROM doc_url)
+        :param tracer: CALLED WITH A tracing.Span AFTER EVERY SCHEME LOADER CALL
+        :return: EXPANDED JSON-SERIALIZABLE STRUCTURE
+        """
+        url = self.url.set_query(set_default({}, params, self.url.query))
+        token = _finished.set(self.finished)
+        fragments_token = _fragments.set({})
+        try:
+            with tracing(tracer):
+                phase1 = self.template.render(url)
+                phase2 = _replace_locals((phase1, None), url)
+        finally:
+            _fragments.reset(fragments_token)
+            _finished.reset(token)
+        return to_data(phase2)
+
+    def _compile(self, path, dynamic):
+        result = [None]
+        # (path, target, index) - PUT THE TEMPLATE FOR path INTO target[index]
+        stack = [(path, result, 0)]
+        while stack:
+            path, target, index = stack.pop()
+            node, _ = path
+            if id(node) not in dynamic:
+                value = _replace_foreign_ref(path, self.url)
+                if self._finish(value):
+                    self._register(value)
+                target[index] = _Static(value)
+            elif is_list(node):
+                items = [None] * len(node)
+                target[index] = _List(items)
+                stack.extend(((n, path), items, i) for i, n in reversed(list(enumerate(node))))
+            elif "$ref" in node:
+                target[index] = _Hole(path)
+            else:
+                keys = [(k, _has_template(k)) for k in node.keys()]
+                items = [None] * len(keys)
+                target[index] = _Dict(path, keys, items)
+                stack.extend(((v, path), items, i) for i, v in reversed(list(enumerate(node.values()))))
+        return result[0]
+
+    def _finish(self, value):
+        """
+        :return: True IF THE SECOND PHASE ONLY COPIES value
+        BIGGEST SUCH PARTS, BELOW A value THAT IS NOT, ARE EXPANDED NOW
+        """
+        # PARENTS COME BEFORE CHILDREN IN order, SO DECIDE IN REVERSE
+        order = []
+        stack = [value]
+        while stack:
+            v = stack.pop()
+            if is_data(v):
+                children = list(v.values())
+            elif is_list(v):
+                children = v
+            else:
+                continue
+            order.append((v, children))
+            stack.extend(children)
+
+        flags = {}
+
+        def is_final(v):
+            if is_data(v) or is_list(v):
+                return flags[id(v)]
+            elif isinstance(v, str):
+                return not _has_template(v)
+            return True
+
+        for v, children in reversed(order):
+            child_flags = [is_final(c) for c in children]
+            final = flags[id(v)] = all(child_flags) and not (is_data(v) and any(op in v for op in operators))
+            if not final:
+                for c, flag in zip(children, child_flags):
+                    if flag:
+                        self._register(c)
+        return is_final(value)
+
+    def _register(self, value):
+        if is_data(value) or is_list(value):
+            self.finished[id(value)] = value, _replace_locals((value, None), self.url)
+
+
+class _Static:
+    __slots__ = ["value"]
+
+    def __init__(self, value):
+        self.value = value
+
+    def render(self, url):
+        return self.value
+
+
+class _Hole:
+    """
+    ref-object THAT MUST BE LOADED WITH THE params
+    """
+
+    __slots__ = ["path"]
+
+    def __init__(self, path):
+        self.path = path
+
+    def render(self, url):
+        return _replace_foreign_ref(self.path, url)
+
+
+class _List:
+    __slots__ = ["items"]
+
+    def __init__(self, items):
+        self.items = items
+
+    def render(self, url):
+        return [item.render(url) for item in self.items]
+
+
+class _Dict:
+    __slots__ = ["path", "keys", "items"]
+
+    def __init__(self, path, keys, items):
+        self.path = path
+        self.keys = keys  # (key, is_template) PAIRS
+        self.items = items
+
+    def render(self, url):
+        output = {}
+        for (k, is_template), item in zip(self.keys, self.items):
+            if is_template:
+                k = _replace_str(k, self.path, url)
+            output[k] = item.render(url)
+        return output
+
+
+def _has_template(text):
+    """
+    :return: True IF text HAS A TEMPLATE THAT DEPENDS ON THE params
+    """
+    template = _parse_template(text)
+    return template is not None and any(ref.split("://", 1)[0] in CONTEXT_SCHEMES for ref in template[1::2])
+
+
+def _find_dynamic(path, url, dynamic):
+    """
+    ADD id() OF EVERY NODE WHOSE FOREIGN REFERENCES DEPEND ON THE params
+    """
+    # (node, parent, is_dynamic) WITH PARENTS BEFORE CHILDREN
+    order = []
+    stack = [path]
+    while stack:
+        path = stack.pop()
+        node, parent = path
+        if is_list(node):
+            order.append((node, parent, False))
+            stack.extend((n, path) for n in node)
+        elif is_data(node):
+            order.append((node, parent, any(_has_template(k) for k in node.keys()) or _is_dynamic_ref(node, url)))
+            stack.extend((v, path) for v in node.values())
+
+    for node, parent, is_dynamic in reversed(order):
+        if is_dynamic or id(node) in dynamic:
+            dynamic.add(id(node))
+            if parent:
+                dynamic.add(id(parent[0]))
+
+
+def _is_dynamic_ref(node, url):
+    if "$ref" not in node:
+        return False
+    raw_ref = str(node["$ref"])
+    if _has_template(raw_ref):
+        return True
+    ref = parse_url(raw_ref)
+    if ref.scheme or ref.path:
+        return (ref.scheme or url.scheme) in PARAM_SCHEMES
+    return False
@@ -0,0 +1,169 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from contextvars import ContextVar, copy_context
+from threading import Lock
+
+from mo_dots import is_data, is_list
+from mo_imports import delay_import
+
+from mo_json_config.cache import parse_url, remote_cache
+from mo_json_config.registry import scheme_loaders
+from mo_json_config.tracing import _tracer, call_async_loader, call_loader
+from mo_json_config.watch import _loads
+
+asyncio = delay_import("asyncio")
+ThreadPoolExecutor = delay_import("concurrent.futures.ThreadPoolExecutor")
+
+LOCAL_SCHEMES = ("param", "env", "ref", "scheme")  # NOT WORTH A THREAD
+
+_prefetch = ContextVar("prefetch", default=None)
+
+
+class Prefetch:
+    """
+    FOREIGN REFERENCES BEING LOADED IN THE BACKGROUND, BY ref-object
+    THE DEPTH-FIRST WALK STILL DECIDES WHAT IS DONE WITH EACH RESULT, SO
+    OUTPUT AND ERRORS ARE THE SAME AS A SEQUENTIAL EXPANSION
+    """
+
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.pending = {}  # MAP FROM _path_key(path) TO (path, Future, can_inline)
+        self.lock = Lock()
+        self.token = None
+
+    def submit(self, loader, ref, path, url):
+        future = self.executor.submit(copy_context().run, call_loader, loader, ref, path, url, _has_default(path))
+        self._add(path, future, True)
+
+    def _add(self, path, future, can_inline):
+        with self.lock:
+            self.pending[_path_key(path)] = path, future, can_inline
+
+    def take(self, path):
+        """
+        :return: Future WITH THE LOADED VALUE, OR None IF CALLER MUST LOAD IT
+        """
+        with self.lock:
+            _, future, can_inline = self.pending.pop(_path_key(path), (None, None, False))
+        if future is None or (can_inline and future.cancel()):
+            # NOT STARTED YET, SO DO NOT WAIT FOR A WORKER
+            return None
+        return future
+
+    def __enter__(self):
+        self.token = _prefetch.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _prefetch.reset(self.token)
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for _, future, _ in pending.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class AsyncPrefetch(Prefetch):
+    """
+    SCHEMES FOUND IN async_scheme_loaders ARE AWAITED ON THE EVENT LOOP, THE
+    REST FALL BACK TO THREADS
+    """
+
+    def __init__(self, loop, max_workers=None):
+        Prefetch.__init__(self, max_workers)
+        self.loop = loop
+
+    def submit(self, loader, ref, path, url):
+        async_loader = remote_cache.async_loader(ref.scheme)
+        if async_loader is None:
+            return Prefetch.submit(self, loader, ref, path, url)
+        # THE LOOP IS FREE BECAUSE THE WALK IS ON A THREAD, SO WAITING IS SAFE
+        coroutine = call_async_loader(_tracer.get(), async_loader, ref, path, url, _has_default(path))
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        self._add(path, future, False)
+
+
+def prefetch_foreign_refs(path, url):
+    """
+    START LOADING THE FOREIGN REFERENCES FOUND IN DOCUMENT, IF PREFETCH IS ON
+    """
+    prefetch = _prefetch.get()
+    if prefetch is None:
+        return
+    if url.path.endswith("/"):
+        url.path = url.path[:-1]
+    for ref, ref_path in _find_foreign_refs(path, url):
+        prefetch.submit(remote_cache.loader(ref.scheme), ref, ref_path, url)
+
+
+def _find_foreign_refs(path, url):
+    """
+    YIELD (ref, path) FOR EACH FOREIGN REFERENCE THAT CAN BE LOADED WITHOUT
+    KNOWING THE REST OF THE DOCUMENT
+    """
+    stack = [path]
+    while stack:
+        path = stack.pop()
+        node, _ = path
+        if is_list(node):
+            stack.extend((n, path) for n in reversed(node))
+            continue
+        elif not is_data(node):
+            continue
+
+        stack.extend((v, path) for k, v in reversed(list(node.items())) if k != "$ref")
+
+        if "$ref" not in node:
+            continue
+        raw_ref = str(node["$ref"])
+        if "{" in raw_ref:
+            # TEMPLATE MUST BE EXPANDED IN ORDER
+            continue
+        ref = parse_url(raw_ref)
+        if not ref.scheme and not ref.path:
+            continue
+        if not ref.scheme:
+            ref.scheme = url.scheme
+        if ref.scheme in LOCAL_SCHEMES or ref.scheme not in scheme_loaders:
+            continue
+        yield ref, (node, path)
+
+
+def _path_key(path):
+    # THE SAME DOCUMENT CAN BE INCLUDED MORE THAN ONCE, SO node IS NOT ENOUGH
+    key = []
+    while path:
+        key.append(id(path[0]))
+        path = path[1]
+    return tuple(key)
+
+
+def _load(ref, path, url):
+    loads = _loads.get()
+    if loads is not None:
+        # WATCHED, SO REUSE WHAT DOES NOT DEPEND ON A CHANGED FILE
+        return loads.load(_load_now, ref, path, url)
+    return _load_now(ref, path, url)
+
+
+def _load_now(ref, path, url):
+    prefetch = _prefetch.get()
+    if prefetch is not None:
+        future = prefetch.take(path)
+        if future is not None:
+            return future.result()
+    return call_loader(remote_cache.loader(ref.scheme), ref, path, url, _has_default(path))
+
+
+def _has_default(path):
+    # path IS (ref-object, parent)
+    node = path[0]
+    return is_data(node) and "$default" in node
@@ -0,0 +1,146 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from collections.abc import MutableMapping
+from importlib import import_module
+from threading import Lock
+
+from mo_logs import logger
+
+ENTRY_POINTS = "mo_json_config.schemes"  # loader(ref, path, url) PROVIDED BY OTHER PACKAGES
+ASYNC_ENTRY_POINTS = "mo_json_config.async_schemes"
+
+
+class SchemeLoaders(MutableMapping):
+    """
+    MAP FROM scheme TO loader(ref, path, url)
+    A loader MAY BE GIVEN AS "module:function", WHICH IS IMPORTED ON FIRST USE
+    SCHEMES NOT FOUND ARE LOOKED UP IN THE entry_points GROUP, ONCE
+    """
+
+    def __init__(self, group, loaders):
+        self._loaders = dict(loaders)
+        self._group = group
+        self._discovered = False
+        self._lock = Lock()
+
+    def __getitem__(self, scheme):
+        loader = self._loaders.get(scheme)
+        if loader is None:
+            if self._discover():
+                loader = self._loaders.get(scheme)
+            if loader is None:
+                raise KeyError(scheme)
+        if not callable(loader):
+            with self._lock:
+                loader = self._loaders[scheme] = _resolve(loader)
+        return loader
+
+    def __contains__(self, scheme):
+        return scheme in self._loaders or (self._discover() and scheme in self._loaders)
+
+    def get(self, scheme, default=None):
+        try:
+            return self[scheme]
+        except KeyError:
+            return default
+
+    def __setitem__(self, scheme, loader):
+        self._loaders[scheme] = loader
+
+    def __delitem__(self, scheme):
+        del self._loaders[scheme]
+
+    def __iter__(self):
+        self._discover()
+        return iter(list(self._loaders))
+
+    def __len__(self):
+        self._discover()
+        return len(self._loaders)
+
+    def _discover(self):
+        """
+        :return: True IF SCHEMES WERE ADDED
+        """
+        if self._discovered:
+            return False
+        with self._lock:
+            if self._discovered:
+                return False
+            self._discovered = True
+            found = False
+            for entry_point in _entry_points(self._group):
+                if entry_point.name not in self._loaders:
+                    self._loaders[entry_point.name] = entry_point
+                    found = True
+            return found
+
+    def __repr__(self):
+        return f"SchemeLoaders({sorted(self._loaders)})"
+
+
+def register_scheme(scheme, loader=None, async_loader=None):
+    """
+    :param scheme: THE URL SCHEME, eg "vault" FOR {"$ref": "vault://secret/db"}
+    :param loader: loader(ref, path, url), OR "module:function" TO IMPORT WHEN THE SCHEME IS FIRST USED
+    :param async_loader: async loader(ref, path, url) FOR expand_async(), OR "module:function"
+    """
+    if loader is not None:
+        scheme_loaders[scheme] = loader
+    if async_loader is not None:
+        async_scheme_loaders[scheme] = async_loader
+
+
+def _resolve(loader):
+    if hasattr(loader, "load"):
+        # importlib.metadata.EntryPoint
+        return loader.load()
+    module, _, name = loader.partition(":")
+    if not name:
+        logger.error("Expecting loader as \"module:function\", not {loader|quote}", loader=loader)
+    output = import_module(module)
+    for step in name.split("."):
+        output = getattr(output, step)
+    return output
+
+
+def _entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except Exception:
+        return []
+    try:
+        return list(entry_points(group=group))
+    except TypeError:
+        # PYTHON < 3.10
+        return list(entry_points().get(group, []))
+    except Exception as cause:
+        logger.warning("Can not read entry points for {group}", group=group, cause=cause)
+        return []
+
+
+scheme_loaders = SchemeLoaders(
+    ENTRY_POINTS,
+    {
+        "http": "mo_json_config.http:get_http",
+        "https": "mo_json_config.http:get_http",
+        "file": "mo_json_config.schemes:_get_file",
+        "env": "mo_json_config.schemes:_get_env",
+        "param": "mo_json_config.schemes:_get_param",
+        "keyring": "mo_json_config.schemes:_get_keyring",
+        "ssm": "mo_json_config.ssm:get_ssm",
+        "s3": "mo_json_config.s3:get_s3",
+        "ref": "mo_json_config.schemes:_get_value_from_fragment",
+        "scheme": "mo_json_config.schemes:_nothing",
+    },
+)
+
+# async def loader(ref, doc_path, url), USED INSTEAD OF scheme_loaders BY expand_async()
+async_scheme_loaders = SchemeLoaders(ASYNC_ENTRY_POINTS, {})
@@ -0,0 +1,113 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import os
+from threading import Lock
+
+from mo_dots import from_data
+from mo_imports import delay_import
+from mo_json import json2value
+from mo_logs import logger
+
+from mo_json_config.cache import DocumentCache, NOTSET, _url_path, url_key
+from mo_json_config.throttle import limiter
+from mo_json_config.tracing import record
+
+boto3 = delay_import("boto3")
+_copy = delay_import("mo_json_config.expand_locals._copy")
+
+MAX_BYTES = 64 * 1024 * 1024  # LARGEST OBJECT ACCEPTED
+CHUNK_BYTES = 1024 * 1024
+
+# PARSED OBJECTS, WITH THEIR ETag, TO ASK S3 IF THEY CHANGED
+s3_cache = DocumentCache(normalize=_url_path)
+
+_clients = {}  # MAP FROM (service, region, profile) TO boto3 CLIENT
+_clients_lock = Lock()
+
+
+def get_s3(ref, doc_path, url):
+    bucket, key = ref.host, ref.path.strip("/")
+    cache_key = url_key(f"s3://{bucket}/{key}", ref.query)
+    found = s3_cache.peek(cache_key)
+    try:
+        request = {"Bucket": bucket, "Key": key}
+        if found is not NOTSET:
+            request["IfNoneMatch"] = found[0]
+        limit = limiter("s3")
+        if limit:
+            limit.acquire()
+        try:
+            response = client("s3").get_object(**request)
+        except Exception as cause:
+            if found is not NOTSET and _is_not_modified(cause):
+                etag, value = found
+                record(cache_hit=True, fingerprint=etag)
+                return _copy(value)
+            raise
+        etag = response.get("ETag")
+        content = _read(response["Body"])
+        record(bytes_read=len(content), cache_hit=False if etag else None, fingerprint=etag)
+        new_value = from_data(json2value(content.decode("utf8"), params=ref.query, flexible=True, leaves=True))
+    except Exception as e:
+        logger.error("Failed to retrieve s3://{bucket}/{key} as JSON", bucket=bucket, key=key, cause=e)
+        return None
+    if etag:
+        s3_cache.set(cache_key, etag, new_value, len(content))
+        return _copy(new_value)
+    return new_value
+
+
+def client(service):
+    """
+    :return: boto3 CLIENT FOR service, SHARED BY ALL THREADS (CLIENTS ARE THREAD SAFE, SESSIONS ARE NOT)
+    ONE PER REGION AND PROFILE, AS SET IN THE ENVIRONMENT
+    """
+    region = os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION")
+    profile = os.environ.get("AWS_PROFILE")
+    key = service, region, profile
+    found = _clients.get(key)
+    if found is not None:
+        return found
+    with _clients_lock:
+        found = _clients.get(key)
+        if found is None:
+            found = _clients[key] = boto3.session.Session(region_name=region, profile_name=profile).client(service)
+        return found
+
+
+def close():
+    """
+    FORGET THE CLIENTS (eg AFTER CREDENTIALS CHANGE) AND THE OBJECTS
+    """
+    with _clients_lock:
+        _clients.clear()
+    s3_cache.invalidate()
+
+
+def _is_not_modified(cause):
+    response = getattr(cause, "response", None) or {}
+    return response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 304
+
+
+def _read(body):
+    """
+    :return: THE OBJECT, NO LARGER THAN MAX_BYTES
+    """
+    chunks = []
+    size = 0
+    try:
+        for chunk in body.iter_chunks(CHUNK_BYTES):
+            size += len(chunk)
+            if size > MAX_BYTES:
+                logger.error("Object is larger than {max} bytes", max=MAX_BYTES)
+            chunks.append(chunk)
+    finally:
+        body.close()
+    return b"".join(chunks)
@@ -10,19 +10,22 @@
 
 import os
 
-from mo_dots import get_attr
 from mo_files import File
 from mo_imports import delay_import
 from mo_json import json2value
 from mo_logs import Except, logger
 
-from mo_json_config.convert import ini2value
+from mo_json_config.cache import env_fingerprint, file_cache, file_fingerprint, file_key, NOTSET
 from mo_future import mockable
-from mo_json_config.ssm import get_ssm as _get_ssm
+from mo_json_config.registry import async_scheme_loaders, scheme_loaders  # STILL IMPORTED FROM HERE BY OTHER PACKAGES
+from mo_json_config.tracing import record
+from mo_json_config.watch import included
 
 _replace_foreign_ref = delay_import("mo_json_config.expander._replace_foreign_ref")
-_replace_locals = delay_import("mo_json_config.expander._replace_locals")
-boto3 = delay_import("boto3")
+_replace_fragment = delay_import("mo_json_config.expand_locals._replace_fragment")
+prefetch_foreign_refs = delay_import("mo_json_config.prefetch.prefetch_foreign_refs")
+ini2value = delay_import("mo_json_config.convert.ini2value")
+get_http = delay_import("mo_json_config.http.get_http")  # STILL IMPORTED FROM HERE, WITHOUT LOADING requests UNTIL USED
 
 CAN_NOT_READ_FILE = "Can not read file {filename}"
 
@@ -31,13 +34,39 @@ CAN_NOT_READ_FILE = "Can not read file {filename}"
 def _get_file(ref, path, url):
     filename = ref.path
     file = File(filename)
+    candidates = [file]
     if not filename.startswith(("/", "~")):
         # RELATIVE FILE, CHECK FOR SIBLING FIRST
-        file = File(url.path).parent / filename or file
+        sibling = File(url.path).parent / filename
+        candidates.insert(0, sibling)
+        file = sibling or file
+    ref = ref.set_path(file.abs_path)
+    record(url=ref)
     if not file:
+        # WATCHED ANYWAY, SO A $default IS REPLACED WHEN THE FILE APPEARS
+        for candidate in candidates:
+            included(candidate.os_path, None)
         logger.error("File {filename} does not exist", filename=file.abs_path)
-    ref = ref.set_path(file.abs_path)
 
+    key = file_key(file.abs_path, ref.query)
+    fingerprint = file_fingerprint(file.os_path)
+    included(file.os_path, fingerprint)
+    record(fingerprint=fingerprint)
+    new_value = file_cache.get(key, fingerprint) if fingerprint else NOTSET
+    if new_value is NOTSET:
+        new_value, size = _parse_file(file, ref)
+        record(bytes_read=size, cache_hit=False if fingerprint else None)
+        if fingerprint:
+            file_cache.set(key, fingerprint, new_value, size)
+    else:
+        record(cache_hit=True)
+    prefetch_foreign_refs((new_value, path), ref)
+    # THE CACHED DOCUMENT IS NEVER RETURNED, ONLY THIS (DEEP) COPY
+    new_value = _replace_foreign_ref((new_value, path), ref)
+    return new_value
+
+
+def _parse_file(file, ref):
     try:
         content = file.read()
     except Exception as e:
@@ -52,16 +81,7 @@ def _get_file(ref, path, url):
             new_value = ini2value(content)
         except Exception:
             raise logger.error(CAN_NOT_READ_FILE, filename=file, cause=e)
-    new_value = _replace_foreign_ref((new_value, path), ref)
-    return new_value
-
-
-def get_http(ref, doc_path, url):
-    import requests
-
-    params = url.query
-    new_value = json2value(requests.get(str(ref)).text, params=params, flexible=True, leaves=True)
-    return new_value
+    return new_value, len(content)
 
 
 def _get_env(ref, doc_path, url):
@@ -70,6 +90,7 @@ def _get_env(ref, doc_path, url):
     raw_value = os.environ.get(ref)
     if not raw_value:
         logger.error("expecting environment variable with name {env_var}", env_var=ref)
+    record(fingerprint=env_fingerprint(raw_value))
 
     try:
         new_value = json2value(raw_value)
@@ -126,42 +147,14 @@ def _get_value_from_fragment(ref, path, url):
                 doc = doc[1]
             else:
                 break
-        new_value = get_attr(doc[0], frag[i::])
+        return _replace_fragment(doc[0], frag[i::], ref, path, url)
     else:
         # ABSOLUTE
         top_doc = path
         while isinstance(top_doc, tuple) and top_doc[1]:
             top_doc = top_doc[1]
-        new_value = get_attr(top_doc[0], frag)
-    new_value = _replace_locals((new_value, path), url)
-    return new_value
-
-
-def _get_s3(ref, doc_path, url):
-    key = ref.path.strip("/")
-    try:
-        content = boto3.client("s3").get_object(Bucket=ref.host, Key=key)["Body"].read().decode("utf-8")
-        return json2value(content, params=ref.query, flexible=True, leaves=True)
-    except Exception as e:
-        logger.error(
-            "Failed to retrieve s3://{bucket}/{key} as JSON", bucket=ref.host, key=key, cause=e
-        )
-        return None
+        return _replace_fragment(top_doc[0], frag, ref, path, url)
 
 
 def _nothing(ref, doc_path, url):
     return f"{{{ref}}}"
-
-
-scheme_loaders = {
-    "http": get_http,
-    "https": get_http,
-    "file": _get_file,
-    "env": _get_env,
-    "param": _get_param,
-    "keyring": _get_keyring,
-    "ssm": _get_ssm,
-    "s3": _get_s3,
-    "ref": _get_value_from_fragment,
-    "scheme": _nothing,
-}
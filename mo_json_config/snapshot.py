@@ -0,0 +1,146 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import json
+import marshal
+import os
+from hashlib import sha256
+from time import time
+
+from mo_dots import from_data
+from mo_files import File
+from mo_logs import logger
+
+from mo_json_config.cache import env_fingerprint, file_fingerprint, parse_url
+
+VERSION = 1
+LOCAL_SCHEMES = ("param", "ref", "scheme")  # PART OF THE KEY, OR OF THE DOCUMENT ITSELF
+SECRET_SCHEMES = ("keyring", "ssm")
+SECRET_POLICIES = ("skip", "encrypt")
+
+
+class SnapshotCache:
+    """
+    EXPANDED DOCUMENTS ON DISK, USED UNTIL ONE OF THEIR SOURCES CHANGES
+
+    FILES AND ENVIRONMENT VARIABLES ARE CHECKED ON EVERY USE. OTHER SOURCES
+    (http, s3, ssm, keyring) CAN NOT BE CHECKED WITHOUT LOADING THEM, SO A
+    SNAPSHOT WITH THEM IS ONLY KEPT FOR max_age SECONDS (NOT AT ALL IF None)
+    """
+
+    def __init__(self, directory, secrets="skip", key=None, max_age=None):
+        """
+        :param directory: WHERE TO KEEP THE SNAPSHOTS
+        :param secrets: "skip" TO NEVER STORE A DOCUMENT WITH keyring OR ssm VALUES, "encrypt" TO STORE IT ENCRYPTED
+        :param key: FERNET KEY (FROM cryptography.fernet.Fernet.generate_key()) FOR secrets="encrypt"
+        :param max_age: SECONDS A SNAPSHOT WITH SOURCES THAT CAN NOT BE CHECKED IS USED
+        """
+        if secrets not in SECRET_POLICIES:
+            logger.error("Expecting secrets to be one of {policies}", policies=SECRET_POLICIES)
+        if secrets == "encrypt" and not key:
+            logger.error("Expecting a key to encrypt secrets")
+        self.directory = File(directory)
+        self.secrets = secrets
+        self.key = key
+        self.max_age = max_age
+
+    def load(self, doc, url):
+        """
+        :return: THE EXPANDED doc, OR None IF THERE IS NO VALID SNAPSHOT
+        """
+        file = self._file(doc, url)
+        try:
+            with open(file.os_path, "rb") as stream:
+                snapshot = marshal.load(stream)
+        except FileNotFoundError:
+            return None
+        except Exception as cause:
+            logger.warning("Can not read snapshot {file}", file=file.abs_path, cause=cause)
+            return None
+        if snapshot.get("version") != VERSION or not self._is_current(snapshot):
+            return None
+        payload = snapshot["payload"]
+        if snapshot["encrypted"]:
+            payload = _fernet(self.key).decrypt(payload)
+        return marshal.loads(payload)
+
+    def save(self, doc, url, graph, result):
+        """
+        :param graph: DependencyGraph OF THE EXPANSION
+        :param result: THE EXPANDED doc
+        """
+        sources = {}
+        for found in graph.sources.values():
+            for source, detail in found.items():
+                sources[source] = detail["scheme"], detail["fingerprint"]
+
+        schemes = {scheme for scheme, _ in sources.values()}
+        if schemes & set(SECRET_SCHEMES) and self.secrets == "skip":
+            return
+        if self.max_age is None and any(not _can_check(s) for s in schemes):
+            return
+
+        payload = marshal.dumps(from_data(result))
+        encrypted = self.secrets == "encrypt" and bool(schemes & set(SECRET_SCHEMES))
+        if encrypted:
+            payload = _fernet(self.key).encrypt(payload)
+        snapshot = {
+            "version": VERSION,
+            "created": time(),
+            "sources": sources,
+            "encrypted": encrypted,
+            "payload": payload,
+        }
+        file = self._file(doc, url)
+        try:
+            os.makedirs(self.directory.os_path, exist_ok=True)
+            # WRITE, THEN RENAME, SO A READER NEVER SEES HALF A SNAPSHOT
+            temp = file.os_path + f".{os.getpid()}.tmp"
+            with open(temp, "wb") as stream:
+                marshal.dump(snapshot, stream)
+            os.replace(temp, file.os_path)
+        except Exception as cause:
+            logger.warning("Can not write snapshot {file}", file=file.abs_path, cause=cause)
+
+    def clear(self):
+        for file in self.directory.children:
+            if file.extension == "snapshot":
+                file.delete()
+
+    def _file(self, doc, url):
+        # THE DOCUMENT, WHERE IT CAME FROM, AND ITS PARAMETERS
+        key = json.dumps([from_data(doc), str(url), from_data(url.query)], sort_keys=True, default=str)
+        return self.directory / (sha256(key.encode("utf8")).hexdigest() + ".snapshot")
+
+    def _is_current(self, snapshot):
+        age = time() - snapshot["created"]
+        for source, (scheme, fingerprint) in snapshot["sources"].items():
+            if scheme == "file":
+                if file_fingerprint(File(parse_url(source).path).os_path) != fingerprint:
+                    return False
+            elif scheme == "env":
+                value = os.environ.get(parse_url(source).host)
+                if (env_fingerprint(value) if value else None) != fingerprint:
+                    return False
+            elif scheme not in LOCAL_SCHEMES:
+                if self.max_age is None or age > self.max_age:
+                    return False
+        return True
+
+
+def _can_check(scheme):
+    return scheme in ("file", "env") or scheme in LOCAL_SCHEMES
+
+
+def _fernet(key):
+    try:
+        from cryptography.fernet import Fernet
+    except Exception:
+        logger.error("Missing cryptography: `pip install cryptography` to encrypt snapshots")
+    return Fernet(key)
@@ -8,18 +8,23 @@
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
 
-import re
-
 from mo_dots import Data, join_field
 from mo_files import URL
 from mo_future import get_function_name
 from mo_imports import delay_import
 from mo_logs import logger, Except
 
+from mo_json_config.throttle import backoff, limiter
+from mo_json_config.tracing import record
+
 boto3 = delay_import("boto3")
+ThreadPoolExecutor = delay_import("concurrent.futures.ThreadPoolExecutor")
 
-RETRY_SECONDS = 1
+RETRY_SECONDS = 1  # FIRST BACKOFF, DOUBLED ON EVERY RETRY
+MAX_RETRY_SECONDS = 20
 TIMEOUT_SECONDS = 60
+PAGE_SIZE = 10  # MOST PARAMETERS SSM RETURNS PER CALL
+MAX_WORKERS = 1  # MORE THAN ONE TO FETCH THE PARAMETERS OF A LARGE PATH CONCURRENTLY
 
 Till = delay_import("mo_threads.till.Till")
 
@@ -32,19 +37,29 @@ def _retry(func):
 
     def output(*args, **kwargs):
         timeout = Till(seconds=TIMEOUT_SECONDS)
-        cause = None
+        limit = limiter("ssm")
+        last_cause = None
+        attempt = 0
         while not timeout:
+            if limit:
+                limit.acquire()
             try:
                 call_counts[func_name] += 1
-                return func(*args, **kwargs)
+                result = func(*args, **kwargs)
             except Exception as cause:
-                cause = Except.wrap(cause)
-                if "ThrottlingException" in cause.message:
-                    logger.warning("Throttled", cause=cause)
-                    Till(seconds=RETRY_SECONDS).wait()
+                last_cause = Except.wrap(cause)
+                if "ThrottlingException" in last_cause.message:
+                    logger.warning("Throttled", cause=last_cause)
+                    if limit:
+                        limit.throttled()
+                    Till(seconds=backoff(attempt, RETRY_SECONDS, MAX_RETRY_SECONDS)).wait()
+                    attempt += 1
                     continue
-                logger.error("failure with {func}", func=func_name, cause=cause)
-        logger.error("timeout with {func}", func=func_name, cause=cause)
+                logger.error("failure with {func}", func=func_name, cause=last_cause)
+            if limit:
+                limit.succeeded()
+            return result
+        logger.error("timeout with {func}", func=func_name, cause=last_cause)
 
     return output
 
@@ -53,6 +68,7 @@ def get_ssm(ref, doc_path=None, location=None):
     global has_failed
 
     output = Data()
+    versions = {}  # MAP FROM PARAMETER TO ITS VERSION
 
     if has_failed:
         return output
@@ -60,35 +76,68 @@ def get_ssm(ref, doc_path=None, location=None):
     if isinstance(ref, str):
         ref = URL(ref)
 
+    path = ref.path.rstrip("/")
     try:
         ssm = boto3.client("ssm")
-        describe_parameters = _retry(ssm.describe_parameters)
-        get_parameter = _retry(ssm.get_parameter)
-
-        filters = [{"Key": "Name", "Option": "BeginsWith", "Values": [ref.path.rstrip("/")]}]
-
-        result = describe_parameters(MaxResults=10, ParameterFilters=filters)
-        prefix = re.compile("^" + re.escape(ref.path.rstrip("/")) + "(?:/|$)")
-        while True:
-            for param in result["Parameters"]:
-                name = param["Name"]
-                found = prefix.match(name)
-                if not found:
-                    continue
-                tail = join_field(name[found.regs[0][1] :].split("/"))
-                if not tail:
-                    return get_parameter(Name=name, WithDecryption=True)["Parameter"]["Value"]
-                detail = get_parameter(Name=name, WithDecryption=True)
-                output[tail] = detail["Parameter"]["Value"]
-
-            next_token = result.get("NextToken")
-            if not next_token:
-                break
-            result = describe_parameters(NextToken=next_token, MaxResults=10, ParameterFilters=filters)
+        if path:
+            # A PARAMETER WITH EXACTLY THIS NAME IS THE VALUE
+            found = _retry(ssm.get_parameters)(Names=[path], WithDecryption=True)["Parameters"]
+            if found:
+                record(fingerprint=found[0].get("Version"))
+                return found[0]["Value"]
+
+        if MAX_WORKERS > 1:
+            parameters = _get_parameters_parallel(ssm, path)
+        else:
+            parameters = _get_parameters_by_path(ssm, path)
+        for param in parameters:
+            tail = join_field(param["Name"][len(path) :].strip("/").split("/"))
+            output[tail] = param["Value"]
+            versions[tail] = param.get("Version")
     except Exception as cause:
         has_failed = True
         logger.warning("Could not get ssm parameters", cause=cause)
 
     if len(output) == 0:
         logger.error("No ssm parameters found at {path}", path=ref.path)
+    record(fingerprint=versions)
     return output
+
+
+def _get_parameters_by_path(ssm, path):
+    """
+    :return: ALL PARAMETERS UNDER path, WITH VALUES, TEN PER CALL
+    """
+    get_parameters_by_path = _retry(ssm.get_parameters_by_path)
+    request = {"Path": path or "/", "Recursive": True, "WithDecryption": True, "MaxResults": PAGE_SIZE}
+    while True:
+        result = get_parameters_by_path(**request)
+        yield from result["Parameters"]
+        next_token = result.get("NextToken")
+        if not next_token:
+            return
+        request["NextToken"] = next_token
+
+
+def _get_parameters_parallel(ssm, path):
+    """
+    :return: ALL PARAMETERS UNDER path; THE NAMES ARE LISTED FIFTY PER CALL, THEN THE VALUES ARE
+    FETCHED TEN PER CALL, ON MAX_WORKERS THREADS
+    """
+    describe_parameters = _retry(ssm.describe_parameters)
+    get_parameters = _retry(ssm.get_parameters)
+
+    names = []
+    request = {"ParameterFilters": [{"Key": "Path", "Option": "Recursive", "Values": [path or "/"]}], "MaxResults": 50}
+    while True:
+        result = describe_parameters(**request)
+        names.extend(p["Name"] for p in result["Parameters"])
+        next_token = result.get("NextToken")
+        if not next_token:
+            break
+        request["NextToken"] = next_token
+
+    batches = [names[i : i + PAGE_SIZE] for i in range(0, len(names), PAGE_SIZE)]
+    with ThreadPoolExecutor(MAX_WORKERS) as executor:
+        for result in executor.map(lambda batch: get_parameters(Names=batch, WithDecryption=True), batches):
+            yield from result["Parameters"]
@@ -0,0 +1,109 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from random import uniform
+from threading import Lock
+from time import monotonic
+
+from mo_imports import delay_import
+
+Till = delay_import("mo_threads.till.Till")
+
+SSM_RATE = 40  # CALLS PER SECOND, THE DEFAULT SSM THROUGHPUT FOR AN ACCOUNT
+MIN_RATE_RATIO = 0.05  # THROTTLING NEVER SLOWS A LIMITER BELOW THIS FRACTION OF ITS rate
+RECOVERY_RATIO = 0.05  # EACH SUCCESS GIVES BACK THIS FRACTION OF THE rate
+
+
+class TokenBucket:
+    """
+    AT MOST rate CALLS PER SECOND, WITH BURSTS OF burst, SHARED BY ALL THREADS
+    THROTTLING HALVES THE RATE, AND EACH SUCCESS SLOWLY RAISES IT BACK
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate  # CONFIGURED CALLS PER SECOND
+        self.burst = burst or rate
+        self.current_rate = rate  # AFTER ADAPTING TO THROTTLING
+        self.calls = 0
+        self.waits = 0
+        self.waited_seconds = 0.0
+        self.throttles = 0
+        self._tokens = self.burst
+        self._last = monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        """
+        WAIT FOR A TURN
+        """
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.current_rate)
+            self._last = now
+            # A DEBT IS A PLACE IN LINE
+            self._tokens -= 1
+            wait = -self._tokens / self.current_rate if self._tokens < 0 else 0
+            self.calls += 1
+            if wait:
+                self.waits += 1
+                self.waited_seconds += wait
+        if wait:
+            Till(seconds=wait).wait()
+
+    def throttled(self):
+        with self._lock:
+            self.throttles += 1
+            self.current_rate = max(self.rate * MIN_RATE_RATIO, self.current_rate / 2)
+
+    def succeeded(self):
+        if self.current_rate == self.rate:
+            return
+        with self._lock:
+            self.current_rate = min(self.rate, self.current_rate + self.rate * RECOVERY_RATIO)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "current_rate": self.current_rate,
+                "calls": self.calls,
+                "waits": self.waits,
+                "waited_seconds": self.waited_seconds,
+                "throttles": self.throttles,
+            }
+
+
+def set_limit(service, rate, burst=None):
+    """
+    :param service: "ssm", "s3", ...
+    :param rate: CALLS PER SECOND FOR THIS PROCESS (None FOR NO LIMIT)
+    :param burst: CALLS ALLOWED AT ONCE (DEFAULT rate)
+    """
+    if rate is None:
+        limiters.pop(service, None)
+    else:
+        limiters[service] = TokenBucket(rate, burst)
+
+
+def limiter(service):
+    """
+    :return: THE TokenBucket FOR service, OR None IF NOT LIMITED
+    """
+    return limiters.get(service)
+
+
+def backoff(attempt, base, maximum):
+    """
+    :return: SECONDS TO WAIT BEFORE RETRY NUMBER attempt (FROM ZERO): EXPONENTIAL, WITH FULL JITTER
+    """
+    return uniform(0, min(maximum, base * 2 ** attempt))
+
+
+# MAP FROM SERVICE TO TokenBucket
+limiters = {"ssm": TokenBucket(SSM_RATE)}
@@ -0,0 +1,284 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+from mo_dots import from_data, is_data, is_list, join_field
+from mo_logs import logger
+
+# tracer(span) IS CALLED AFTER EVERY SCHEME LOADER CALL
+_tracer = ContextVar("tracer", default=None)
+# THE Span OF THE LOADER RUNNING NOW, SO THE LOADER CAN ADD DETAIL
+_span = ContextVar("span", default=None)
+
+
+class Span:
+    """
+    ONE CALL TO A SCHEME LOADER
+    """
+
+    __slots__ = [
+        "scheme",
+        "url",
+        "start",
+        "duration",
+        "bytes_read",
+        "cache_hit",
+        "fingerprint",
+        "outcome",
+        "error",
+        "_path",
+    ]
+
+    def __init__(self, scheme, url, path=None):
+        self.scheme = scheme
+        self.url = url  # TEXT, WITH SECRETS REMOVED
+        self.start = perf_counter()
+        self.duration = None  # SECONDS, INCLUDING THE REFERENCES IT LOADED IN TURN
+        self.bytes_read = None
+        self.cache_hit = None  # None IF THERE IS NO CACHE
+        self.fingerprint = None  # VERSION OF THE SOURCE (eg FILE (mtime, size, inode), HTTP ETag), IF KNOWN
+        self.outcome = None  # "ok", "error", OR "default" IF THE $default IS USED INSTEAD
+        self.error = None
+        self._path = path  # (node, parent) GIVEN TO THE LOADER
+
+    @property
+    def path(self):
+        """
+        :return: THE PATH IN THE OUTPUT THAT DEPENDS ON THIS LOAD
+        """
+        return output_path(self._path)
+
+    def __data__(self):
+        output = {k: getattr(self, k) for k in self.__slots__ if k not in ("error", "_path")}
+        output["path"] = self.path
+        return output
+
+    def __repr__(self):
+        return f"Span({self.scheme}, {self.url}, {self.outcome})"
+
+
+@contextmanager
+def tracing(tracer):
+    """
+    SEND A Span TO tracer FOR EVERY SCHEME LOADER CALLED IN THIS CONTEXT
+    """
+    if tracer is None:
+        yield
+        return
+    token = _tracer.set(tracer)
+    try:
+        yield
+    finally:
+        _tracer.reset(token)
+
+
+def tee(*tracers):
+    """
+    :return: ONE tracer THAT CALLS ALL THE GIVEN tracers (None ARE IGNORED)
+    """
+    tracers = [t for t in tracers if t is not None]
+    if len(tracers) == 1:
+        return tracers[0]
+
+    def tracer(span):
+        for t in tracers:
+            t(span)
+
+    return tracer
+
+
+def call_loader(loader, ref, path, url, fallback=False):
+    """
+    :param fallback: True IF A FAILURE WILL BE REPLACED BY THE $default
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        return loader(ref, path, url)
+    span = Span(ref.scheme or "ref", redact(ref), path)
+    token = _span.set(span)
+    try:
+        output = loader(ref, path, url)
+        span.outcome = "ok"
+        return output
+    except Exception as cause:
+        span.outcome = "default" if fallback else "error"
+        span.error = cause
+        raise
+    finally:
+        span.duration = perf_counter() - span.start
+        _span.reset(token)
+        _send(tracer, span)
+
+
+async def call_async_loader(tracer, loader, ref, path, url, fallback=False):
+    """
+    SAME AS call_loader(), BUT THE tracer IS GIVEN BECAUSE THE EVENT LOOP HAS ITS OWN CONTEXT
+    """
+    if tracer is None:
+        return await loader(ref, path, url)
+    span = Span(ref.scheme, redact(ref), path)
+    token = _span.set(span)
+    try:
+        output = await loader(ref, path, url)
+        span.outcome = "ok"
+        return output
+    except Exception as cause:
+        span.outcome = "default" if fallback else "error"
+        span.error = cause
+        raise
+    finally:
+        span.duration = perf_counter() - span.start
+        _span.reset(token)
+        _send(tracer, span)
+
+
+def record(bytes_read=None, cache_hit=None, fingerprint=None, url=None):
+    """
+    CALLED BY LOADERS TO ADD DETAIL TO THE CURRENT Span (IF TRACING)
+    :param url: THE URL ACTUALLY LOADED, IF DIFFERENT (eg A RELATIVE FILE MADE ABSOLUTE)
+    """
+    span = _span.get()
+    if span is None:
+        return
+    if url is not None:
+        span.url = redact(url)
+    if bytes_read is not None:
+        span.bytes_read = (span.bytes_read or 0) + bytes_read
+    if cache_hit is not None:
+        span.cache_hit = cache_hit
+    if fingerprint is not None:
+        span.fingerprint = fingerprint
+
+
+def output_path(path):
+    """
+    :param path: (node, parent) AS GIVEN TO A LOADER
+    :return: DOT-DELIMITED PATH OF node IN THE EXPANDED OUTPUT ("." FOR THE ROOT)
+    """
+    keys = []
+    while path and path[1]:
+        node, parent = path
+        key = _find_key(parent[0], node)
+        if key is None:
+            # node IS WHAT A ref-object LOADED, SO IT TAKES THE PLACE OF THE ref-object
+            pass
+        elif isinstance(key, str) and key.startswith("$"):
+            # $default, $concat, ... ARE REPLACED BY WHAT THEY EXPAND TO
+            keys.clear()
+        else:
+            keys.append(str(key))
+        path = parent
+    return join_field(reversed(keys))
+
+
+def _find_key(container, node):
+    raw = from_data(node)
+    if is_data(container):
+        for k, v in from_data(container).items():
+            if v is raw or v is node:
+                return k
+    elif is_list(container):
+        for i, v in enumerate(from_data(container)):
+            if v is raw or v is node:
+                return i
+    return None
+
+
+def redact(ref):
+    """
+    :return: ref AS TEXT, WITHOUT THE QUERY VALUES (WHICH MAY HOLD TOKENS)
+    """
+    text = f"{ref.scheme}://" if ref.scheme else ""
+    if ref.host:
+        text += ref.host
+    if ref.port:
+        text += f":{ref.port}"
+    if ref.path:
+        text += ref.path if not ref.host or ref.path.startswith("/") else "/" + ref.path
+    keys = sorted(ref.query.keys()) if ref.query else None
+    if keys:
+        text += "?" + "&".join(f"{k}=****" for k in keys)
+    if ref.fragment:
+        text += "#" + ref.fragment
+    return text
+
+
+def _send(tracer, span):
+    try:
+        tracer(span)
+    except Exception as cause:
+        logger.warning("tracer failed", cause=cause)
+
+
+class TraceSummary:
+    """
+    A tracer THAT KEEPS THE SPANS, TO REPORT THE SLOWEST REFERENCES
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = Lock()
+
+    def __call__(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def slowest(self, limit=10):
+        with self._lock:
+            spans = list(self.spans)
+        return sorted(spans, key=lambda s: s.duration, reverse=True)[:limit]
+
+    def by_scheme(self):
+        """
+        :return: MAP FROM scheme TO TOTALS
+        """
+        output = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            total = output.setdefault(
+                span.scheme,
+                {"count": 0, "duration": 0.0, "bytes_read": 0, "hits": 0, "misses": 0, "errors": 0, "defaults": 0},
+            )
+            total["count"] += 1
+            total["duration"] += span.duration
+            total["bytes_read"] += span.bytes_read or 0
+            if span.cache_hit is True:
+                total["hits"] += 1
+            elif span.cache_hit is False:
+                total["misses"] += 1
+            if span.outcome == "error":
+                total["errors"] += 1
+            elif span.outcome == "default":
+                total["defaults"] += 1
+        return output
+
+    def report(self, limit=10):
+        """
+        :return: TEXT TABLE OF THE SLOWEST REFERENCES, AND THE TOTALS BY SCHEME
+        """
+        lines = ["slowest references:"]
+        for span in self.slowest(limit):
+            detail = [span.outcome]
+            if span.bytes_read is not None:
+                detail.append(f"{span.bytes_read} bytes")
+            if span.cache_hit is not None:
+                detail.append("cache hit" if span.cache_hit else "cache miss")
+            lines.append(f"{span.duration * 1000:10.1f}ms  {span.url}  ({', '.join(detail)})")
+        lines.append("by scheme:")
+        for scheme, total in sorted(self.by_scheme().items(), key=lambda p: -p[1]["duration"]):
+            lines.append(
+                f"{total['duration'] * 1000:10.1f}ms  {scheme}  ({total['count']} calls, {total['bytes_read']} bytes,"
+                f" {total['hits']} hits, {total['misses']} misses, {total['errors']} errors, {total['defaults']} defaults)"
+            )
+        return "\n".join(lines)
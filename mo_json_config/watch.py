@@ -0,0 +1,218 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import os
+from contextvars import ContextVar
+from threading import Event, Lock, Thread
+
+from mo_dots import from_data, to_data
+from mo_files import File
+from mo_files.url import URL
+from mo_imports import delay_import
+from mo_logs import Except, logger, get_stacktrace
+
+from mo_json_config.cache import file_fingerprint
+
+Configuration = delay_import("mo_json_config.configuration.Configuration")
+_expand = delay_import("mo_json_config.expander._expand")
+_doc_url = delay_import("mo_json_config.expander._doc_url")
+_copy = delay_import("mo_json_config.expand_locals._copy")
+
+LOOKBACK = 1
+DEFAULT_INTERVAL = 1.0  # SECONDS BETWEEN POLLS, OR LONGEST WAIT FOR AN inotify EVENT
+
+# THE Loads OF THE EXPANSION BEING WATCHED
+_loads = ContextVar("loads", default=None)
+
+
+def watch(url, on_change=None, interval=DEFAULT_INTERVAL):
+    """
+    LOAD THE CONFIGURATION AT url, AND RELOAD IT WHEN A FILE IT INCLUDED CHANGES
+
+    :param url: SAME AS get()
+    :param on_change: CALLED WITH THE NEW Configuration AFTER EVERY RELOAD
+    :param interval: SECONDS BETWEEN CHECKS
+    :return: A STARTED Watcher
+    """
+    caller = URL("file://" + File(get_stacktrace(start=LOOKBACK)[0]["file"]).abs_path)
+    return Watcher(url, on_change, interval, caller).start()
+
+
+class Watcher:
+    """
+    HOLDS THE LATEST Configuration. ONLY THE FOREIGN REFERENCES THAT DEPEND ON
+    A CHANGED FILE ARE LOADED AGAIN, THE REST ARE TAKEN FROM THE LAST EXPANSION
+    """
+
+    def __init__(self, url, on_change=None, interval=DEFAULT_INTERVAL, doc_url="param://"):
+        self.url = url
+        self.on_change = on_change
+        self.interval = interval
+        self._doc_url = doc_url
+        self._loads = Loads()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+        self._notify = None
+        self._watched = {}  # MAP FROM DIRECTORY TO inotify WATCH DESCRIPTOR
+        self.configuration = self._expand()
+
+    @property
+    def files(self):
+        """
+        :return: PATHS OF THE FILES THE CONFIGURATION INCLUDED
+        """
+        return set(self._loads.files)
+
+    def start(self):
+        self._notify = _inotify()
+        self._watch_directories()
+        self._thread = Thread(target=self._run, name="watch " + str(self.url), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._notify is not None:
+            self._notify.close()
+            self._notify = None
+
+    def check(self):
+        """
+        RELOAD IF AN INCLUDED FILE CHANGED
+        :return: True IF RELOADED
+        """
+        with self._lock:
+            if not self._loads.changed():
+                return False
+            try:
+                configuration = self._expand()
+            except Exception as cause:
+                # PROBABLY HALFWAY THROUGH AN EDIT, KEEP THE LAST GOOD CONFIGURATION
+                logger.warning("Can not reload {url}", url=self.url, cause=Except.wrap(cause))
+                return False
+            self.configuration = configuration
+            self._watch_directories()
+        if self.on_change is not None:
+            try:
+                self.on_change(configuration)
+            except Exception as cause:
+                logger.warning("on_change failed for {url}", url=self.url, cause=cause)
+        return True
+
+    def _expand(self):
+        loads = Loads(self._loads)
+        token = _loads.set(loads)
+        try:
+            doc = _expand(to_data({"$ref": self.url}), _doc_url(self._doc_url, None))
+        finally:
+            _loads.reset(token)
+        self._loads = loads
+        return Configuration(doc)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._notify is None:
+                self._stop.wait(self.interval)
+            else:
+                # ANY EVENT IS ONLY A HINT, THE FINGERPRINTS DECIDE
+                self._notify.read(timeout=int(self.interval * 1000), read_delay=50)
+            if self._stop.is_set():
+                break
+            try:
+                self.check()
+            except Exception as cause:
+                logger.warning("problem watching {url}", url=self.url, cause=cause)
+
+    def _watch_directories(self):
+        if self._notify is None:
+            return
+        from inotify_simple import flags
+
+        # EDITORS OFTEN REPLACE THE FILE, SO WATCH THE DIRECTORY
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE | flags.MODIFY
+        for directory in {os.path.dirname(f) for f in self._loads.files} - set(self._watched):
+            try:
+                self._watched[directory] = self._notify.add_watch(directory, mask)
+            except OSError as cause:
+                logger.warning("Can not watch {directory}, will poll", directory=directory, cause=cause)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class Loads:
+    """
+    FOREIGN REFERENCES LOADED BY ONE EXPANSION, WITH THE FILES EACH DEPENDS ON
+    """
+
+    def __init__(self, previous=None):
+        self.previous = previous.memo if previous else {}
+        self.memo = {}  # MAP FROM (ref, url) TO (output, {os_path: fingerprint})
+        self.files = {}  # MAP FROM os_path TO fingerprint, FOR EVERY FILE INCLUDED
+        self.frames = []  # THE {os_path: fingerprint} OF THE LOADS IN PROGRESS
+
+    def load(self, loader, ref, path, url):
+        key = str(ref), str(url)
+        found = self.memo.get(key) or self.previous.get(key)
+        if found is not None and not _changed(found[1]):
+            output, files = self.memo[key] = found
+            self.included(files)
+            return _copy(output)
+
+        files = {}
+        self.frames.append(files)
+        try:
+            output = _copy(from_data(loader(ref, path, url)))
+        finally:
+            # A FAILED LOAD STILL DEPENDS ON THE FILES IT READ
+            self.frames.pop()
+            self.included(files)
+        self.memo[key] = output, files
+        return _copy(output)
+
+    def included(self, files):
+        self.files.update(files)
+        for frame in self.frames:
+            frame.update(files)
+
+    def changed(self):
+        return _changed(self.files)
+
+
+def included(os_path, fingerprint):
+    """
+    CALLED BY THE file LOADER, SO THE FILE IS WATCHED
+    """
+    loads = _loads.get()
+    if loads is not None:
+        loads.included({os_path: fingerprint})
+
+
+def _changed(files):
+    # A MISSING FILE HAS fingerprint None, SO IT CHANGED WHEN IT APPEARS
+    return any(file_fingerprint(f) != fingerprint for f, fingerprint in files.items())
+
+
+def _inotify():
+    """
+    :return: inotify_simple.INotify, OR None IF NOT AVAILABLE (SO WE POLL)
+    """
+    try:
+        from inotify_simple import INotify
+
+        return INotify()
+    except Exception:
+        return None
@@ -0,0 +1,297 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+"""
+SPEED AND MEMORY OF EXPANSION, AND OF Configuration ACCESS, ON SYNTHETIC CONFIGS
+
+    python -m tests.benchmark                               # RUN ALL
+    python -m tests.benchmark --only wide,deep --scale 0.1  # SMALLER, FASTER
+    python -m tests.benchmark --save baseline.json
+    python -m tests.benchmark --compare baseline.json --threshold 1.25
+
+WITH --compare, THE EXIT CODE IS 1 IF ANY MEASURE IS threshold TIMES WORSE THAN THE BASELINE
+"""
+import argparse
+import gc
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from statistics import median
+
+from mo_files import File
+from mo_json import json2value, value2json
+
+import mo_json_config
+from mo_json_config import Configuration
+from mo_json_config.cache import file_cache
+from mo_json_config.registry import scheme_loaders
+
+REMOTE_SCHEMES = ("http", "https", "s3", "ssm")
+CASES = {}
+IMPORT = "import"  # NOT A CASE: THE TIME TO import mo_json_config IN A NEW PROCESS
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def case(func):
+    CASES[func.__name__] = func
+    return func
+
+
+@case
+def wide(scale, directory):
+    size = int(10_000 * scale) or 1
+    doc = {f"key{i}": {"name": f"name{i}", "value": i, "enabled": i % 2 == 0} for i in range(size)}
+    return doc, "param://", None, [f"key{i}.name" for i in range(0, size, max(1, size // 100))]
+
+
+@case
+def deep(scale, directory):
+    depth = int(2_000 * scale) or 1
+    doc = {"leaf": "bottom"}
+    for i in range(depth):
+        doc = {"level": i, "child": doc, "sibling": {"value": i}}
+    return doc, "param://", None, [".".join(["child"] * min(depth - 1, 50) + ["level"])]
+
+
+@case
+def ref_heavy(scale, directory):
+    size = int(2_000 * scale) or 1
+    doc = {
+        "defaults": {"database": {"host": "localhost", "port": 5432, "options": {"timeout": 30, "retries": 3}}},
+        "services": {
+            f"service{i}": {
+                "name": f"service{i}",
+                "database": {"$ref": "#defaults.database", "port": 6000 + i},
+                "label": {"$ref": "#..name"},
+            }
+            for i in range(size)
+        },
+    }
+    return doc, "param://", None, [f"services.service{i}.database.host" for i in range(0, size, max(1, size // 100))]
+
+
+@case
+def template_heavy(scale, directory):
+    size = int(5_000 * scale) or 1
+    doc = {
+        f"endpoint{i}": {"url": "https://{param://host}:{param://port}/api/" + str(i), "user": "{env://BENCHMARK_USER}"}
+        for i in range(size)
+    }
+    os.environ["BENCHMARK_USER"] = "benchmark"
+    return doc, "param://", {"host": "example.com", "port": "8080"}, [f"endpoint{i}.url" for i in range(0, size, max(1, size // 100))]
+
+
+@case
+def file_includes(scale, directory):
+    size = int(200 * scale) or 1
+    File(os.path.join(directory, "shared.json")).write(value2json({"region": "us-east-1", "tags": list(range(20))}))
+    for i in range(size):
+        File(os.path.join(directory, f"include{i}.json")).write(
+            value2json({"id": i, "shared": {"$ref": "shared.json"}, "values": list(range(50))})
+        )
+    doc = {f"part{i}": {"$ref": f"include{i}.json"} for i in range(size)}
+    return doc, "file://" + File(directory).abs_path + "/main.json", None, [f"part{i}.shared.region" for i in range(size)]
+
+
+@case
+def large_arrays(scale, directory):
+    size = int(100_000 * scale) or 1
+    doc = {
+        "numbers": list(range(size)),
+        "records": [{"id": i, "name": f"record{i}"} for i in range(size // 10 or 1)],
+    }
+    return doc, "param://", None, ["numbers", "records"]
+
+
+@case
+def remote(scale, directory):
+    size = int(50 * scale) or 1
+    doc = {
+        "http": [{"$ref": f"https://config.example.com/service{i}.json"} for i in range(size)],
+        "s3": [{"$ref": f"s3://bucket/config{i}.json"} for i in range(size)],
+        "ssm": [{"$ref": f"ssm:///services/service{i}"} for i in range(size)],
+    }
+    return doc, "param://", None, ["http", "s3", "ssm"]
+
+
+@contextmanager
+def fake_remote(latency=0.01):
+    """
+    REPLACE THE http, https, s3 AND ssm LOADERS WITH ONES THAT WAIT latency SECONDS
+    """
+
+    def fake_loader(ref, doc_path, url):
+        time.sleep(latency)
+        return {"scheme": ref.scheme, "path": ref.path, "host": "db.example.com", "port": 5432}
+
+    original = {s: scheme_loaders[s] for s in REMOTE_SCHEMES}
+    scheme_loaders.update({s: fake_loader for s in REMOTE_SCHEMES})
+    try:
+        yield
+    finally:
+        scheme_loaders.update(original)
+
+
+def measure(func, repeat):
+    """
+    :return: (MINIMUM, MEDIAN) SECONDS OF repeat CALLS
+    """
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), median(timings)
+
+
+def peak_memory(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def import_time():
+    """
+    :return: SECONDS TO import mo_json_config IN A NEW PROCESS (THE INTERPRETER START IS NOT COUNTED)
+    """
+    code = "import time; start = time.perf_counter(); import mo_json_config; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, check=True, text=True)
+    return float(output.stdout)
+
+
+def run(names=None, scale=1.0, repeat=5, latency=0.01, max_workers=16):
+    """
+    :return: MAP FROM case TO MAP FROM measure TO VALUE
+    """
+    results = {}
+    if not names or IMPORT in names:
+        timings = [import_time() for _ in range(repeat)]
+        results[IMPORT] = {"import": min(timings), "import_median": median(timings)}
+    with tempfile.TemporaryDirectory() as directory, fake_remote(latency):
+        for name in names or CASES:
+            if name == IMPORT:
+                continue
+            case_dir = os.path.join(directory, name)
+            os.makedirs(case_dir)
+            doc, doc_url, params, paths = CASES[name](scale, case_dir)
+
+            main = File(os.path.join(case_dir, "main.json"))
+            main.write(value2json(doc))
+            main_url = "file://" + main.abs_path
+
+            def expand():
+                return mo_json_config.expand(doc, doc_url, params)
+
+            def get():
+                file_cache.invalidate()
+                return mo_json_config.get(main_url)
+
+            expanded = expand()
+
+            def configuration_init():
+                return Configuration(expanded)
+
+            config = configuration_init()
+
+            def configuration_getattr():
+                for path in paths:
+                    value = config
+                    for step in path.split("."):
+                        value = getattr(value, step)
+
+            measures = [("expand", expand)]
+            if params is None:
+                # param:// IS NOT AVAILABLE TO THE FILE THAT get() LOADS
+                measures.append(("get", get))
+            measures.extend([("configuration_init", configuration_init), ("configuration_getattr", configuration_getattr)])
+            result = results[name] = {}
+            for measure_name, func in measures:
+                result[measure_name], result[measure_name + "_median"] = measure(func, repeat)
+            if name == "remote":
+                result["expand_concurrent"], result["expand_concurrent_median"] = measure(
+                    lambda: mo_json_config.expand(doc, doc_url, params, max_workers=max_workers), repeat
+                )
+            result["peak_bytes"] = peak_memory(expand)
+    return results
+
+
+def compare(results, baseline, threshold=1.25):
+    """
+    :return: LIST OF (case, measure, baseline, result, ratio) THAT ARE threshold TIMES WORSE
+    """
+    regressions = []
+    for name, measures in results.items():
+        for measure_name, value in measures.items():
+            if measure_name.endswith("_median"):
+                continue
+            before = baseline.get(name, {}).get(measure_name)
+            if not before:
+                continue
+            ratio = value / before
+            if ratio > threshold:
+                regressions.append((name, measure_name, before, value, ratio))
+    return regressions
+
+
+def _format(measure_name, value):
+    if measure_name == "peak_bytes":
+        return f"{value / 1_000_000:10.2f}MB"
+    return f"{value * 1000:10.2f}ms"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark mo-json-config")
+    parser.add_argument("--only", help="comma separated cases: " + ", ".join([IMPORT, *CASES]))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the size of every config")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds each fake remote load takes")
+    parser.add_argument("--save", help="write results to this file")
+    parser.add_argument("--compare", help="baseline file from an earlier --save")
+    parser.add_argument("--threshold", type=float, default=1.25, help="ratio to baseline that counts as a regression")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(",") if args.only else None
+    results = run(names, scale=args.scale, repeat=args.repeat, latency=args.latency)
+    baseline = json2value(File(args.compare).read()) if args.compare else {}
+
+    for name, measures in results.items():
+        print(name)
+        for measure_name, value in measures.items():
+            if measure_name.endswith("_median"):
+                continue
+            line = f"    {measure_name:24}{_format(measure_name, value)}"
+            before = baseline.get(name, {}).get(measure_name)
+            if before:
+                line += f"  ({value / before:5.2f}x baseline)"
+            print(line)
+
+    if args.save:
+        File(args.save).write(value2json(results, pretty=True))
+    if args.compare:
+        regressions = compare(results, baseline, args.threshold)
+        for name, measure_name, before, value, ratio in regressions:
+            print(
+                f"REGRESSION {name}.{measure_name}: {_format(measure_name, before).strip()} ->"
+                f" {_format(measure_name, value).strip()} ({ratio:.2f}x)"
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at https://www.mozilla.org/en-US/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import subprocess
+import sys
+
+from mo_testing.fuzzytestcase import FuzzyTestCase
+
+from mo_json_config.registry import scheme_loaders
+from tests.benchmark import CASES, IMPORT, ROOT, compare, fake_remote, run
+
+# NOT NEEDED UNTIL A DOCUMENT IS EXPANDED, OR expand_async() IS CALLED
+LAZY_MODULES = [
+    "asyncio",
+    "concurrent.futures",
+    "mo_json_config.schemes",
+    "mo_json_config.ssm",
+    "mo_json_config.convert",
+]
+
+
+class TestBenchmark(FuzzyTestCase):
+    def test_run(self):
+        # KEEP THE BENCHMARK WORKING, AT A SIZE THAT DOES NOT SLOW THE TESTS
+        results = run(scale=0.001, repeat=1, latency=0)
+        self.assertEqual(set(results.keys()), {IMPORT, *CASES.keys()})
+        self.assertGreater(results[IMPORT]["import"], 0)
+        for name, measures in results.items():
+            if name == IMPORT:
+                continue
+            self.assertGreater(measures["expand"], 0)
+            self.assertGreater(measures["peak_bytes"], 0)
+        self.assertIn("expand_concurrent", results["remote"])
+
+    def test_compare(self):
+        baseline = {"wide": {"expand": 1.0, "expand_median": 1.0, "peak_bytes": 100}}
+        results = {"wide": {"expand": 1.1, "expand_median": 9.0, "peak_bytes": 200}, "deep": {"expand": 5.0}}
+        self.assertEqual(compare(results, baseline, threshold=1.25), [("wide", "peak_bytes", 100, 200, 2.0)])
+
+    def test_fake_remote_restores_loaders(self):
+        original = dict(scheme_loaders)
+        with fake_remote(latency=0):
+            self.assertNotEqual(scheme_loaders["s3"], original["s3"])
+        self.assertEqual(scheme_loaders, original)
+
+    def test_import_is_lazy(self):
+        code = "import sys, mo_json_config; print([m for m in sys.argv[1:] if m in sys.modules])"
+        output = subprocess.run(
+            [sys.executable, "-c", code, *LAZY_MODULES], cwd=ROOT, capture_output=True, check=True, text=True
+        )
+        self.assertEqual(output.stdout.strip(), "[]")
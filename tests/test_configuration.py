@@ -8,15 +8,20 @@
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
 
+import gc
 import os
+import tracemalloc
+from threading import Thread
+from time import sleep
 
+from mo_dots import from_data
 from mo_future import first
 from mo_testing.fuzzytestcase import FuzzyTestCase
 
 os.environ.setdefault("TESTING", "1")
 
 import mo_json_config
-from mo_json_config import Configuration
+from mo_json_config import Configuration, FrozenConfiguration, LayeredConfiguration
 
 
 class TestConfiguration(FuzzyTestCase):
@@ -65,3 +70,180 @@ class TestConfiguration(FuzzyTestCase):
         key, value = first(os.environ.items())
 
         self.assertEqual(c[key], value)
+
+    def test_child_views(self):
+        c = Configuration({"db": {"primaryHost": {"name": "a", "port": 5432}}, "list": [1, 2]})
+
+        db = c.db
+        self.assertIs(c.db, db)
+        self.assertIs(from_data(db._lookup), from_data(c._lookup)["db"])
+        self.assertEqual(db.primary_host.port, 5432)
+        self.assertEqual(c["db.primaryHost.name"], "a")
+
+        get_port = c.accessor("db.PRIMARY_HOST.port")
+        self.assertEqual(get_port(), 5432)
+        with self.assertRaises("db.primary.host.missing"):
+            c.accessor("db.primaryHost.missing")()
+
+        # CHANGES ARE SEEN BY THE ACCESSORS, BUT NOT BY THE VIEWS ALREADY GIVEN OUT
+        c += {"db": {"primary_host": {"port": 1}}}
+        self.assertEqual(c.db.primary.host.port, 5433)
+        self.assertEqual(db.primary.host.port, 5432)
+        c.prepend({"db": {"primary_host": {"port": 6543}}})
+        self.assertEqual(get_port(), 6543)
+
+        # A VIEW CAN NOT BE CHANGED, BUT A COPY OF IT CAN
+        with self.assertRaises("is a view"):
+            c.db.append({"user": "u"})
+        copy = Configuration(c.db)
+        copy.append({"user": "u"})
+        self.assertEqual(copy.user, "u")
+        with self.assertRaises("db.user"):
+            c.db.user
+
+    def test_layers(self):
+        defaults = Configuration({"db": {"host": "localhost", "port": 5432}, "debug": False})
+        c = LayeredConfiguration(defaults, {"db": {"host": "db.example.com"}}, {"DB_PORT": "6543"})
+
+        self.assertEqual(c.db.host, "db.example.com")
+        self.assertEqual(c.db.port, "6543")
+        self.assertEqual(c.debug, False)
+        self.assertEqual(dict(c), {"db.host": "db.example.com", "db.port": "6543", "debug": False})
+        # THE LAYERS ARE NOT COPIED
+        self.assertIs(c.layers[0]._lookup, defaults._lookup)
+
+        c.push({"db": {"port": 1}})
+        self.assertEqual(c.db.port, 1)
+        get_host = c.accessor("db.host")
+        c.push({"db": "sqlite"})
+        self.assertEqual(c.db, "sqlite")
+        c.pop()
+        c.pop()
+        self.assertEqual(c.db.port, "6543")
+        self.assertEqual(get_host(), "db.example.com")
+
+        # A VIEW IS NOT CHANGED, SO IT CAN NOT DISAGREE WITH ITS PARENT
+        for write in (lambda d: d.push({"user": "u"}), lambda d: d.append({"user": "u"}), lambda d: d.pop()):
+            with self.assertRaises("is a view"):
+                write(c.db)
+
+        c |= {"timeout": 30, "db": {"host": "never"}}
+        self.assertEqual(c.timeout, 30)
+        self.assertEqual(c.db.host, "db.example.com")
+        with self.assertRaises("db.user"):
+            c.db.user
+
+    def test_layer_changed_after_push(self):
+        base = Configuration({"x": 1, "y": 2})
+        c = LayeredConfiguration(base, {"z": 3})
+        self.assertEqual(c.x, 1)
+
+        # THE LAYER IS KEPT AS IT WAS, SO WHAT WAS READ AND WHAT WAS NOT AGREE
+        base.prepend({"x": 5, "y": 6})
+        self.assertEqual(base.x, 5)
+        self.assertEqual(c.x, 1)
+        self.assertEqual(c.y, 2)
+        self.assertEqual(dict(c), {"x": 1, "y": 2, "z": 3})
+
+        c.push(base)
+        self.assertEqual(c.x, 5)
+        self.assertEqual(c.y, 6)
+        self.assertEqual(dict(c), {"x": 5, "y": 6, "z": 3})
+
+    def test_write_through_view(self):
+        c = Configuration({"db": {"host": "localhost"}})
+        d = c.db
+        writes = [
+            lambda: d.append({"user": "u"}),
+            lambda: d.prepend({"user": "u"}),
+            lambda: d.__iadd__({"user": "u"}),
+            lambda: d.replace({"user": "u"}),
+            lambda: d.clear(),
+        ]
+        for write in writes:
+            with self.assertRaises("is a view"):
+                write()
+        # THE PARENT, BY ATTRIBUTE OR BY PATH, AGREES WITH THE VIEW
+        self.assertEqual(c.db.host, "localhost")
+        self.assertEqual(c["db.host"], "localhost")
+        self.assertEqual(d.host, "localhost")
+        for read in (lambda: c.db.user, lambda: c["db.user"], lambda: d.user):
+            with self.assertRaises("db.user"):
+                read()
+        self.assertNotIn("user", repr(c))
+
+        # WRITES THROUGH THE PARENT ARE SEEN BOTH WAYS
+        c.append({"db": {"user": "u"}})
+        self.assertEqual(c.db.user, "u")
+        self.assertEqual(c["db.user"], "u")
+
+    def test_snapshot(self):
+        c = Configuration({"a": 0, "b": 0, "list": [1, 2]})
+        before = c.snapshot()
+        c += {"list": [3]}
+        c.prepend({"a": 1})
+        self.assertEqual(before.list, [1, 2])
+        self.assertEqual(before.a, 0)
+        self.assertEqual(c.list, [1, 2, 3])
+        self.assertEqual(c.a, 1)
+
+        # A READER NEVER SEES HALF OF A CHANGE
+        c = Configuration({"a": 0, "b": 0})
+        torn = []
+
+        def write():
+            for _ in range(200):
+                c.__iadd__({"a": 1, "b": 1})
+
+        writer = Thread(target=write)
+        writer.start()
+        while writer.is_alive():
+            now = c.snapshot()
+            if now.a != now.b:
+                torn.append((now.a, now.b))
+            sleep(0)  # LET THE WRITER RUN
+        writer.join()
+        self.assertEqual(torn, [])
+        self.assertEqual(c.a, 200)
+
+    def test_freeze(self):
+        def doc():
+            return {
+                f"service{i}": {"hostName": f"h{i}", "port": 8000 + i, "opts": {"retries": 3, "tags": ["a", {"isOn": True}]}}
+                for i in range(500)
+            }
+
+        c = Configuration(doc())
+        frozen = c.freeze()
+        self.assertEqual(frozen.service7.host_name, "h7")
+        self.assertEqual(frozen["service7.hostName"], "h7")
+        self.assertEqual(frozen.accessor("service7.port")(), 8007)
+        self.assertEqual(frozen.service7.opts.tags[1].is_on, True)
+        self.assertEqual(dict(frozen), dict(c))
+        self.assertEqual(len(frozen), 500)
+        self.assertEqual(len(frozen), len(c))
+        self.assertEqual(len(frozen.service7), len(c.service7))
+        with self.assertRaises("service7.opts.missing"):
+            frozen.service7.opts.missing
+        with self.assertRaises("can not be changed"):
+            frozen.service7 = None
+
+        # EQUAL OBJECTS ARE STORED ONCE
+        self.assertIs(frozen.service1.opts._node, frozen.service2.opts._node)
+        self.assertEqual(hash(frozen), hash(FrozenConfiguration(doc())))
+        self.assertEqual(frozen, FrozenConfiguration(doc()))
+        self.assertEqual(len({frozen.service1.opts, frozen.service2.opts, frozen.service1}), 2)
+
+        def size(make):
+            gc.collect()
+            tracemalloc.start()
+            try:
+                value = make()
+                gc.collect()  # EMPTY THE FREE LISTS, SO ONLY WHAT IS KEPT IS COUNTED
+                return tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+
+        # THE NAMES ARE ALREADY INTERNED, SO ONLY THE STRUCTURE IS COUNTED
+        c.freeze()
+        self.assertLess(size(c.freeze), size(lambda: Configuration(doc())) / 2)
@@ -7,25 +7,36 @@
 #
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
+import asyncio
+import gzip
 import json
 import os
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
 from unittest import skipIf
 
 import boto3
 import keyring
 from botocore.exceptions import ClientError
+from cryptography.fernet import Fernet
 from mo_dots import Data
 from mo_files import File
 from mo_files import URL
 from mo_future import get_function_name, decorate
+from mo_json import value2json
 from mo_logs.exceptions import get_stacktrace
 from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
 from mo_threads import stop_main_thread
 from moto import mock_aws as mock_ssm, mock_aws
 
 import mo_json_config
-from mo_json_config import ssm as _ssm
+from mo_json_config import http as _http, s3 as _s3, ssm as _ssm, throttle, Configuration
+from mo_json_config.cache import MAX_ENTRIES, file_cache, file_fingerprint, parse_url, remote_cache
+from mo_json_config.registry import scheme_loaders, async_scheme_loaders
 from mo_json_config.convert import ini2value
+from mo_json_config.expand_locals import _parse_template
 from mo_json_config.ssm import get_ssm
 
 IS_CI = os.environ.get("CI") or False
@@ -60,6 +71,14 @@ class ThrottlingSsm:
     def get_parameter(self, Name, WithDecryption):
         return self.ssm.get_parameter(Name=Name, WithDecryption=WithDecryption)
 
+    @add_throttling_errors
+    def get_parameters(self, **kwargs):
+        return self.ssm.get_parameters(**kwargs)
+
+    @add_throttling_errors
+    def get_parameters_by_path(self, **kwargs):
+        return self.ssm.get_parameters_by_path(**kwargs)
+
     @add_throttling_errors
     def describe_parameters(self, **kwargs):
         return self.ssm.describe_parameters(**kwargs)
@@ -294,6 +313,7 @@ class TestRef(FuzzyTestCase):
             try:
                 _boto_client, boto3.client = boto3.client, ThrottlingSsm
 
+                throttle.set_limit("ssm", 1000)
                 ssm = boto3.client("ssm")
                 ssm.put_parameter(Name="/services/graylog/host", Value="localhost", Type="String")
                 ssm.put_parameter(Name="/services/graylog/port", Value="1220", Type="String")
@@ -301,8 +321,32 @@ class TestRef(FuzzyTestCase):
                 doc = {"services": {"$ref": "ssm:///services/graylog/host"}}
                 result = mo_json_config.expand(doc, "http://example.com/")
                 self.assertEqual(result, {"services": "localhost"})
+                # EVERY PROCESS SLOWS DOWN, INSTEAD OF RETRYING AT ONCE
+                stats = throttle.limiter("ssm").stats()
+                self.assertEqual(stats["throttles"], 2)
+                self.assertEqual(stats["calls"], 3)
+                self.assertLess(stats["current_rate"], 1000)
             finally:
                 boto3.client = _boto_client
+                throttle.set_limit("ssm", throttle.SSM_RATE)
+
+    def test_token_bucket(self):
+        limit = throttle.TokenBucket(rate=10, burst=1)
+        start = time.time()
+        for _ in range(3):
+            limit.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.15)
+        self.assertEqual(limit.stats()["calls"], 3)
+        self.assertEqual(limit.stats()["waits"], 2)
+
+        limit.throttled()
+        self.assertEqual(limit.current_rate, 5)
+        for _ in range(100):
+            limit.succeeded()
+        self.assertEqual(limit.current_rate, 10)
+
+        for attempt in range(10):
+            self.assertLessEqual(throttle.backoff(attempt, 1, 20), min(20, 2 ** attempt))
 
     @mock_ssm
     def test_ssm_prefix(self):
@@ -318,24 +362,34 @@ class TestRef(FuzzyTestCase):
             a, b = v
             client.put_parameter(Name=f"/services/graylog{a}/{b}/port", Value=str(1220 + i), Type="String")
 
+        expected = {
+            "0": {"port": "1250"},
+            "1": {"port": "1251"},
+            "2": {"port": "1252"},
+            "3": {"port": "1253"},
+            "4": {"port": "1254"},
+            "5": {"port": "1255"},
+            "6": {"port": "1256"},
+            "7": {"port": "1257"},
+            "8": {"port": "1258"},
+            "9": {"port": "1259"},
+        }
         result = mo_json_config.get("ssm:///services/graylog3")
-        self.assertEqual(ssm.call_counts["describe_parameters"], 2)
+        # ONE CALL FOR THE NAME ITSELF, THEN PAGES OF TEN (A FULL PAGE IS FOLLOWED BY AN EMPTY ONE)
+        self.assertEqual(ssm.call_counts["get_parameters"], 1)
+        self.assertEqual(ssm.call_counts["get_parameters_by_path"], 2)
+        self.assertNotIn("get_parameter", ssm.call_counts)
+        self.assertEqual(result, expected)
+        self.assertEqual(len(result), 10)
 
-        self.assertEqual(
-            result,
-            {
-                "0": {"port": "1250"},
-                "1": {"port": "1251"},
-                "2": {"port": "1252"},
-                "3": {"port": "1253"},
-                "4": {"port": "1254"},
-                "5": {"port": "1255"},
-                "6": {"port": "1256"},
-                "7": {"port": "1257"},
-                "8": {"port": "1258"},
-                "9": {"port": "1259"},
-            },
-        )
+        try:
+            ssm.MAX_WORKERS = 4
+            result = mo_json_config.get("ssm:///services")
+            self.assertEqual(len(result), 10)
+            self.assertEqual(result.graylog3, expected)
+            self.assertEqual(result.graylog0["0"].port, "1220")
+        finally:
+            ssm.MAX_WORKERS = 1
 
     def test_env_var_in_string(self):
         os.environ["ENV"] = "test"
@@ -465,6 +519,608 @@ class TestRef(FuzzyTestCase):
         with self.assertRaises(Exception):
             mo_json_config.get("file://~/test.json")
 
+    def test_file_cache(self):
+        file = File("~/test_cache.json")
+        file.write('{"a": "b"}')
+        try:
+            file_cache.invalidate()
+            before = file_cache.stats()
+            doc = {"x": {"$ref": "file://~/test_cache.json"}, "y": {"$ref": "file://~/test_cache.json"}}
+            result = mo_json_config.expand(doc, "file://" + self.resources[7:] + "/")
+            self.assertEqual(result, {"x": {"a": "b"}, "y": {"a": "b"}})
+            after = file_cache.stats()
+            self.assertEqual(after["misses"] - before["misses"], 1)
+            self.assertEqual(after["hits"] - before["hits"], 1)
+
+            # RESULTS DO NOT SHARE THE CACHED DOCUMENT
+            result.x.a = "changed"
+            self.assertEqual(mo_json_config.get("file://~/test_cache.json"), {"a": "b"})
+
+            # CHANGED FILE IS READ AGAIN
+            file.write('{"a": "changed content"}')
+            self.assertEqual(mo_json_config.get("file://~/test_cache.json"), {"a": "changed content"})
+
+            file_cache.invalidate(file.abs_path)
+            self.assertEqual(len(file_cache), 0)
+        finally:
+            file.delete()
+
+    def test_concurrent_refs(self):
+        def slow(ref, path, url):
+            time.sleep(0.2)
+            if ref.host == "fail":
+                raise Exception("expected failure")
+            return {"name": ref.host}
+
+        doc = {
+            "a": {"$ref": "slow://a"},
+            "b": [{"$ref": "slow://b", "extra": 1}, {"$ref": "slow://c"}],
+            "c": {"$ref": "slow://fail", "$default": {"$ref": "slow://d"}},
+            "d": {"e": {"$ref": "slow://e"}, "f": {"$ref": "#a.name"}},
+        }
+        expected = {
+            "a": {"name": "a"},
+            "b": [{"name": "b", "extra": 1}, {"name": "c"}],
+            "c": {"name": "d"},
+            "d": {"e": {"name": "e"}, "f": "a"},
+        }
+        scheme_loaders["slow"] = slow
+        try:
+            start = time.time()
+            result = mo_json_config.expand(doc, "http://example.com/", max_workers=10)
+            duration = time.time() - start
+            self.assertEqual(result, expected)
+            self.assertLess(duration, 0.6)
+
+            self.assertEqual(mo_json_config.expand(doc, "http://example.com/"), expected)
+
+            with self.assertRaises("expected failure"):
+                mo_json_config.expand({"a": {"$ref": "slow://fail"}}, "http://example.com/", max_workers=2)
+        finally:
+            del scheme_loaders["slow"]
+
+    def test_concurrent_file_refs(self):
+        os.environ["test_variable"] = "abc"
+        result = mo_json_config.get(self.resources + "/test_ref1.json", max_workers=1)
+        self.assertEqual(result, mo_json_config.get(self.resources + "/test_ref1.json"))
+
+    def test_expand_async(self):
+        def slow(ref, path, url):
+            time.sleep(0.2)
+            return {"name": ref.host}
+
+        async def slow_async(ref, path, url):
+            await asyncio.sleep(0.2)
+            if ref.host == "fail":
+                raise Exception("expected failure")
+            return {"name": ref.host}
+
+        doc = {
+            "a": {"$ref": "slow://a"},
+            "b": [{"$ref": "sleepy://b", "extra": 1}, {"$ref": "sleepy://c"}],
+            "c": {"$ref": "sleepy://fail", "$default": "default"},
+            "d": {"$ref": "#a.name"},
+        }
+        expected = {
+            "a": {"name": "a"},
+            "b": [{"name": "b", "extra": 1}, {"name": "c"}],
+            "c": "default",
+            "d": "a",
+        }
+        scheme_loaders["slow"] = slow
+        scheme_loaders["sleepy"] = slow
+        async_scheme_loaders["sleepy"] = slow_async
+        try:
+            start = time.time()
+            result = asyncio.run(mo_json_config.expand_async(doc, "http://example.com/"))
+            duration = time.time() - start
+            self.assertEqual(result, expected)
+            self.assertLess(duration, 0.6)
+
+            # SYNC EXPAND IS UNCHANGED
+            expected["c"] = {"name": "fail"}
+            self.assertEqual(mo_json_config.expand(doc, "http://example.com/"), expected)
+        finally:
+            del scheme_loaders["slow"]
+            del scheme_loaders["sleepy"]
+            del async_scheme_loaders["sleepy"]
+
+    def test_get_async(self):
+        os.environ["test_variable"] = "abc"
+        result = asyncio.run(mo_json_config.get_async(self.resources + "/test_ref1.json"))
+        self.assertEqual(result, mo_json_config.get(self.resources + "/test_ref1.json"))
+
+        # RELATIVE TO THIS FILE, NOT TO asyncio
+        result = asyncio.run(mo_json_config.get_async("file://../tests/resources/test_ref2.json"))
+        self.assertEqual(result, mo_json_config.get("file://../tests/resources/test_ref2.json"))
+
+    def test_compile(self):
+        calls = [0]
+
+        def count(ref, path, url):
+            calls[0] += 1
+            return {"name": ref.host, "deep": {"x": [1, 2, {"y": "z"}]}}
+
+        os.environ["test_variable"] = "abc"
+        doc = {
+            "tenant": {"$ref": "param://tenant"},
+            "greeting": "hello {param://tenant}!",
+            "{param://tenant}_key": {"a": {"$ref": "count://inner"}},
+            "shared": {"$ref": "count://shared"},
+            "file": {"$ref": "file://test_ref1.json"},
+            "local": {"$ref": "#shared.name"},
+            "relative": "x {ref://#.tenant}",
+            "list": [{"$ref": "count://l1"}, {"$ref": "param://tenant"}, "plain", {"env": "{env://test_variable}"}],
+            "concat": {"$concat": ["a", {"$ref": "param://tenant"}]},
+            "default": {"$ref": "param://missing.value", "$default": "default"},
+        }
+        doc_url = self.resources + "/doc.json"
+        scheme_loaders["count"] = count
+        try:
+            plan = mo_json_config.compile(doc, doc_url)
+            self.assertEqual(calls[0], 3)
+            for tenant in ["acme", "globex"]:
+                result = plan.render({"tenant": tenant})
+                self.assertEqual(result, mo_json_config.expand(doc, doc_url, {"tenant": tenant}))
+                self.assertEqual(result.greeting, f"hello {tenant}!")
+            self.assertEqual(calls[0], 3 + 2 * 3)
+
+            # RESULTS DO NOT SHARE STRUCTURE
+            result.shared.deep.x = "changed"
+            self.assertEqual(plan.render({"tenant": "acme"}).shared.deep.x, [1, 2, {"y": "z"}])
+        finally:
+            del scheme_loaders["count"]
+
+    def test_lazy(self):
+        calls = []
+
+        def count(ref, path, url):
+            calls.append(ref.host)
+            if ref.host == "fail":
+                raise Exception("expected failure")
+            return {"name": ref.host, "deep": {"x": [1, 2, {"y": "z"}]}}
+
+        doc = {
+            "a": {"$ref": "count://a", "extra": 1},
+            "b": {"$ref": "count://b"},
+            "c": {"$ref": "count://fail", "$default": "default"},
+            "d": {"e": [{"$ref": "count://e"}, 3]},
+            "f": {"$ref": "#a.name"},
+        }
+        scheme_loaders["count"] = count
+        try:
+            result = mo_json_config.expand(doc, lazy=True)
+            # LOCAL REFERENCE NEEDS a
+            self.assertEqual(calls, ["a"])
+            self.assertEqual(result.f, "a")
+
+            self.assertEqual(result.b.name, "b")
+            self.assertEqual(calls, ["a", "b"])
+            self.assertEqual(result.b.name, "b")
+            self.assertEqual(calls, ["a", "b"])
+
+            self.assertEqual(result["d.e"][0].deep.x, [1, 2, {"y": "z"}])
+            self.assertEqual(result.c, "default")
+            self.assertEqual(result, mo_json_config.expand(doc))
+
+            calls.clear()
+            config = Configuration(mo_json_config.expand(doc, lazy=True))
+            self.assertEqual(config.a.extra, 1)
+            self.assertEqual(calls, ["a"])
+            self.assertEqual(config.b.deep.x, [1, 2, {"y": "z"}])
+            self.assertEqual(calls, ["a", "b"])
+        finally:
+            del scheme_loaders["count"]
+
+    def test_lazy_merged_list(self):
+        doc = {"c": {"x": {"$ref": "#.e", "$default": {"d": 3}, "d": ["s3"]}, "e": {"a": 1}}}
+        result = mo_json_config.expand(doc, "param://", {}, lazy=True)
+        merged = result["c"]["x"]["d"]
+        self.assertEqual(list(merged), ["s3", 3])
+        self.assertEqual([v for v in merged], list(mo_json_config.expand(doc, "param://", {}).c.x.d))
+        self.assertEqual(merged[-1], 3)
+        with self.assertRaises(IndexError):
+            merged[2]
+
+    def test_lazy_errors(self):
+        params = {"p": "text", "obj": {"x": 1}}
+        # A STRING CAN NOT BE MERGED WITH THE OTHER PROPERTIES
+        doc = {"a": {"$ref": "param://p", "x": {"y": 1}}}
+        for lazy in (False, True):
+            with self.assertRaises("problem expanding"):
+                mo_json_config.expand(doc, "param://", params, lazy=lazy).a.x
+
+        doc = {"c": {"a": 1, "d": {"$ref": "param://obj", "e": {"$ref": "#c"}}}}
+        for lazy in (False, True):
+            with self.assertRaises("reference cycle"):
+                mo_json_config.expand(doc, "param://", params, lazy=lazy).c.d.e.d.e.d
+
+        # AN OBJECT MERGED INTO A LIST IS ITERATED BY ITS KEYS
+        doc = {"b": {"$ref": "#..c", "$default": {"c": [[], [4]]}}, "c": {"c": {"d": 1}}}
+        result = mo_json_config.expand(doc, "param://", {}, lazy=True)
+        self.assertEqual(list(result.b.c[0]), ["d"])
+        self.assertEqual(result.b.c[0]["d"], 1)
+
+    def test_lazy_file(self):
+        os.environ["test_variable"] = "abc"
+        result = mo_json_config.get(self.resources + "/test_ref1.json", lazy=True)
+        self.assertEqual(result, mo_json_config.get(self.resources + "/test_ref1.json"))
+
+        # THE PARAMETERS OF THE DOCUMENT REACH INTO A FILE INCLUDED BY AN INCLUDED FILE
+        directory = File(tempfile.mkdtemp())
+        try:
+            (directory / "inner.json").write(json.dumps({"y": "{param://p}"}))
+            (directory / "outer.json").write(json.dumps({"k": {"$ref": "file://inner.json"}}))
+            doc = {"a": {"$ref": "file://outer.json"}}
+            url = "file://" + (directory / "root.json").abs_path + "?p=pv"
+            self.assertEqual(mo_json_config.expand(doc, url).a.k.y, "pv")
+            self.assertEqual(mo_json_config.expand(doc, url, lazy=True).a.k.y, "pv")
+        finally:
+            directory.delete()
+
+    def test_single_walk(self):
+        os.environ["test_variable"] = "abc"
+        doc = {
+            "static": {"a": [1, 2, {"b": "plain"}], "c": None},
+            "local": {"$ref": "#static.a.2", "d": "{env://test_variable}"},
+            "concat": {"$concat": ["x", {"$ref": "#static.a.2.b"}], "separator": "-"},
+            "file": {"$ref": self.resources + "/simple.json", "extra": {"e": 1}},
+        }
+        result = mo_json_config.expand(doc, self.resources + "/")
+        self.assertEqual(
+            result,
+            {
+                "static": {"a": [1, 2, {"b": "plain"}]},
+                "local": {"b": "plain", "d": "abc"},
+                "concat": "x-plain",
+                "file": {"test_key": "test_value", "extra": {"e": 1}},
+            },
+        )
+        # OUTPUT SHARES NOTHING WITH THE DOCUMENT
+        result.static.a[2].b = "changed"
+        self.assertEqual(doc["static"]["a"][2]["b"], "plain")
+
+    def test_deep_nesting(self):
+        depth = 3000  # DEEPER THAN THE RECURSION LIMIT
+        doc = {"name": "leaf", "up": {"$ref": "#..name"}, "top": {"$ref": "#top"}, "param": "{param://value}"}
+        for i in range(depth):
+            doc = {"name": i, "child": doc, "list": [[i]]}
+        doc["top"] = "T"
+        result = mo_json_config.expand(doc, params={"value": "hello"})
+        for i in range(depth):
+            self.assertEqual(result.list, [[depth - i - 1]])
+            result = result.child
+        self.assertEqual(result, {"name": "leaf", "up": "leaf", "top": "T", "param": "hello"})
+
+    def test_fragment_memo(self):
+        calls = []
+
+        def get_count(ref, doc_path, url):
+            calls.append(ref)
+            return "db"
+
+        scheme_loaders["count"] = get_count
+        try:
+            doc = {
+                "defaults": {"database": {"host": "{count://host}", "port": 5432}},
+                "a": {"$ref": "#defaults.database"},
+                "b": {"$ref": "#defaults.database", "port": 5433},
+            }
+            result = mo_json_config.expand(doc)
+        finally:
+            del scheme_loaders["count"]
+        self.assertEqual(
+            result,
+            {
+                "defaults": {"database": {"host": "db", "port": 5432}},
+                "a": {"host": "db", "port": 5432},
+                "b": {"host": "db", "port": 5433},
+            },
+        )
+        self.assertEqual(len(calls), 2)  # ONCE FOR defaults, ONCE FOR THE MEMOIZED REFERENCE
+        result.a.host = "changed"
+        self.assertEqual(result.b.host, "db")
+
+    def test_reference_cycle(self):
+        with self.assertRaises("reference cycle #b -> #a -> #b"):
+            mo_json_config.expand({"a": {"$ref": "#b"}, "b": {"c": {"$ref": "#a"}}})
+
+    def test_template_cache(self):
+        self.assertIsNone(_parse_template("plain text"))
+        self.assertIsNone(_parse_template("see https://example.com"))
+        self.assertEqual(_parse_template("a{param://b}c{env://d}"), ("a", "param://b", "c", "env://d", ""))
+
+        doc = {"{param://key}": "x{param://value}y", "plain": "no template"}
+        for value in ["1", "2"]:
+            result = mo_json_config.expand(doc, params={"key": "k", "value": value})
+            self.assertEqual(result, {"k": "x" + value + "y", "plain": "no template"})
+
+    def test_url_cache(self):
+        first = parse_url("ssm://services/a#key")
+        first.scheme = "file"
+        first.path = "/changed"
+        second = parse_url("ssm://services/a#key")
+        self.assertEqual(second.scheme, "ssm")
+        self.assertEqual(second.fragment, "key")
+        self.assertIsNot(first, second)
+
+        # SCHEME-RELATIVE REFS ARE GIVEN THE DOCUMENT SCHEME, WHICH MUST NOT LEAK INTO OTHER DOCUMENTS
+        doc = {"a": {"$ref": "simple.json"}}
+        self.assertEqual(mo_json_config.expand(doc, self.resources + "/doc.json"), {"a": {"test_key": "test_value"}})
+        self.assertFalse(parse_url("simple.json").scheme)
+
+    def test_tracing(self):
+        os.environ["test_variable"] = "abc"
+        file_cache.invalidate()
+        summary = mo_json_config.TraceSummary()
+        doc = {
+            "file": {"$ref": self.resources + "/simple.json?secret=1234"},
+            "again": {"$ref": self.resources + "/simple.json?secret=1234"},
+            "env": "{env://test_variable}",
+            "missing": {"$ref": "env://NOT_A_VARIABLE_NAME", "$default": "fallback"},
+        }
+        result = mo_json_config.expand(doc, tracer=summary)
+        self.assertEqual(result.missing, "fallback")
+
+        spans = {(s.scheme, s.outcome, s.cache_hit) for s in summary.spans}
+        self.assertEqual(
+            spans, {("file", "ok", False), ("file", "ok", True), ("env", "ok", None), ("env", "default", None)},
+        )
+        for span in summary.spans:
+            self.assertNotIn("1234", span.url)
+            self.assertGreaterEqual(span.duration, 0)
+        self.assertEqual(summary.by_scheme()["file"]["bytes_read"], len(File(self.resources[7:] + "/simple.json").read()))
+        self.assertIn("secret=****", summary.report())
+
+    def test_watch(self):
+        calls = []
+
+        def count(ref, path, url):
+            calls.append(ref.host)
+            return {"secret": ref.host}
+
+        directory = File(tempfile.mkdtemp())
+        (directory / "a.json").write(json.dumps({"x": 1, "secret": {"$ref": "count://a"}}))
+        (directory / "b.json").write(json.dumps({"y": 2, "secret": {"$ref": "count://b"}}))
+        (directory / "root.json").write(json.dumps({"a": {"$ref": "a.json"}, "b": {"$ref": "b.json"}, "x": {"$ref": "#a.x"}}))
+        scheme_loaders["count"] = count
+        try:
+            changes = []
+            watcher = mo_json_config.Watcher("file://" + (directory / "root.json").abs_path, changes.append)
+            self.assertEqual(watcher.configuration.a.x, 1)
+            self.assertEqual(watcher.files, {(directory / n).os_path for n in ["root.json", "a.json", "b.json"]})
+            self.assertFalse(watcher.check())
+
+            (directory / "a.json").write(json.dumps({"x": 100, "secret": {"$ref": "count://a"}, "new": True}))
+            self.assertTrue(watcher.check())
+            self.assertEqual(changes, [watcher.configuration])
+            self.assertEqual(watcher.configuration.x, 100)
+            self.assertEqual(watcher.configuration.a.secret.secret, "a")
+            self.assertEqual(watcher.configuration.b.y, 2)
+            # NOTHING ELSE WAS LOADED AGAIN
+            self.assertEqual(calls, ["a", "b"])
+
+            # A BROKEN EDIT KEEPS THE LAST GOOD CONFIGURATION
+            (directory / "b.json").write("{")
+            self.assertFalse(watcher.check())
+            self.assertEqual(watcher.configuration.b.y, 2)
+        finally:
+            del scheme_loaders["count"]
+            directory.delete()
+
+    def test_watch_missing_file(self):
+        directory = File(tempfile.mkdtemp())
+        (directory / "root.json").write(json.dumps({"optional": {"$ref": "optional.json", "$default": "default"}}))
+        try:
+            watcher = mo_json_config.Watcher("file://" + (directory / "root.json").abs_path)
+            self.assertEqual(watcher.configuration.optional, "default")
+            self.assertIn((directory / "optional.json").os_path, watcher.files)
+            self.assertFalse(watcher.check())
+
+            (directory / "optional.json").write(json.dumps({"found": True}))
+            self.assertTrue(watcher.check())
+            self.assertEqual(watcher.configuration.optional.found, True)
+        finally:
+            directory.delete()
+
+    def test_dependency_graph(self):
+        os.environ["test_variable"] = "abc"
+        simple = self.resources + "/simple.json"
+        doc = {
+            "file": {"$ref": simple},
+            "copy": {"$ref": "#file"},
+            "env": {"value": "{env://test_variable}", "name": {"$ref": "#..value"}},
+            "plain": 42,
+        }
+        graph = mo_json_config.DependencyGraph()
+        mo_json_config.expand(doc, tracer=graph)
+
+        self.assertEqual(set(graph.depends_on("file.test_key")), {simple})
+        self.assertEqual(set(graph.depends_on("copy")), {simple})
+        self.assertEqual(set(graph.depends_on("env.name")), {"env://test_variable"})
+        self.assertEqual(graph.depends_on("plain"), {})
+        self.assertEqual(graph.affected_by(simple), ["copy", "file"])
+        self.assertEqual(graph.affected_by("env://test_variable"), ["env", "env.name"])
+        self.assertEqual(graph.depends_on("file")[simple]["fingerprint"], file_fingerprint(simple[7:]))
+
+        copy = mo_json_config.DependencyGraph.from_data(json.loads(value2json(graph.__data__())))
+        self.assertEqual(copy.affected_by(simple), ["copy", "file"])
+
+    def test_snapshot(self):
+        calls = []
+
+        def count(ref, path, url):
+            calls.append(ref.scheme)
+            return "secret value"
+
+        directory = File(tempfile.mkdtemp())
+        (directory / "root.json").write(json.dumps({
+            "env": "{env://test_variable}",
+            "remote": {"$ref": "count://a"},
+            "secret": {"$ref": "keyring://b", "$default": "none"},
+        }))
+        url = "file://" + (directory / "root.json").abs_path
+        os.environ["test_variable"] = "abc"
+        original = scheme_loaders["keyring"]
+        scheme_loaders["count"] = count
+        scheme_loaders["keyring"] = count
+        try:
+            # count:// CAN NOT BE CHECKED, AND keyring IS SECRET, SO NOTHING IS STORED
+            snapshot = mo_json_config.SnapshotCache((directory / "plain").abs_path, max_age=60)
+            mo_json_config.get(url, snapshot=snapshot)
+            mo_json_config.get(url, snapshot=snapshot)
+            self.assertEqual(len(calls), 4)
+
+            key = Fernet.generate_key()
+            snapshot = mo_json_config.SnapshotCache((directory / "secret").abs_path, secrets="encrypt", key=key, max_age=60)
+            first = mo_json_config.get(url, snapshot=snapshot)
+            calls.clear()
+            second = mo_json_config.get(url, snapshot=snapshot)
+            self.assertEqual(calls, [])
+            self.assertEqual(second, first)
+            self.assertEqual(second, {"env": "abc", "remote": "secret value", "secret": "secret value"})
+            for file in (directory / "secret").children:
+                self.assertNotIn(b"secret value", file.read_bytes())
+
+            # A CHANGED SOURCE IS A MISS
+            os.environ["test_variable"] = "def"
+            self.assertEqual(mo_json_config.get(url, snapshot=snapshot).env, "def")
+            self.assertEqual(len(calls), 2)
+        finally:
+            os.environ["test_variable"] = "abc"
+            scheme_loaders["keyring"] = original
+            del scheme_loaders["count"]
+            directory.delete()
+
+    def test_register_scheme(self):
+        os.environ["test_variable"] = "abc"
+        mo_json_config.register_scheme("environment", "mo_json_config.schemes:_get_env")
+        mo_json_config.register_scheme("broken", "mo_json_config.schemes")
+        try:
+            self.assertIn("environment", scheme_loaders)
+            result = mo_json_config.expand({"a": {"$ref": "environment://test_variable"}})
+            self.assertEqual(result, {"a": "abc"})
+            self.assertTrue(callable(scheme_loaders["environment"]))
+
+            with self.assertRaises("Expecting loader as"):
+                mo_json_config.expand({"a": {"$ref": "broken://test_variable"}})
+
+            # OTHER PACKAGES REGISTER THEIR SCHEMES THROUGH schemes
+            from mo_json_config.schemes import async_scheme_loaders as old_async, get_http, scheme_loaders as old
+
+            self.assertIs(old, scheme_loaders)
+            self.assertIs(old_async, async_scheme_loaders)
+            self.assertEqual(get_http.__name__, "get_http")
+        finally:
+            del scheme_loaders["environment"]
+            del scheme_loaders["broken"]
+
+    def test_remote_cache(self):
+        calls = []
+
+        def count(ref, path, url):
+            calls.append(ref.host)
+            if ref.host == "fail":
+                raise Exception("expected failure")
+            return {"name": ref.host, "version": len(calls)}
+
+        doc = {
+            "a": {"$ref": "count://a"},
+            "b": {"$ref": "count://fail", "$default": "default"},
+            "c": {"$ref": "count://a#name"},
+        }
+        scheme_loaders["count"] = count
+        try:
+            remote_cache.set_policy("count", ttl=60, negative_ttl=60)
+            first = mo_json_config.expand(doc)
+            self.assertEqual(first, {"a": {"name": "a", "version": 1}, "b": "default", "c": "a"})
+            self.assertEqual(calls, ["a", "fail"])
+
+            # THE FAILURE IS REMEMBERED, AND THE CACHE IS NOT CHANGED BY THE CALLER
+            first.a.name = "changed"
+            self.assertEqual(mo_json_config.expand(doc), {"a": {"name": "a", "version": 1}, "b": "default", "c": "a"})
+            self.assertEqual(calls, ["a", "fail"])
+
+            remote_cache.invalidate("count")
+            self.assertEqual(mo_json_config.expand(doc).a.version, 3)
+            self.assertEqual(calls, ["a", "fail", "a", "fail"])
+
+            # OLD VALUE IS USED WHILE THE NEW ONE LOADS
+            remote_cache.set_policy("count", ttl=0.01, stale=60)
+            self.assertEqual(mo_json_config.expand({"$ref": "count://a"}).version, 5)
+            time.sleep(0.05)
+            self.assertEqual(mo_json_config.expand({"$ref": "count://a"}).version, 5)
+            for _ in range(100):
+                if len(calls) == 6:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(mo_json_config.expand({"$ref": "count://a"}).version, 6)
+            self.assertGreater(remote_cache.stats()["stale_hits"], 0)
+
+            # BOUNDED
+            remote_cache.max_entries = 2
+            for name in "xyz":
+                mo_json_config.expand({"$ref": f"count://{name}"})
+            self.assertEqual(len(remote_cache), 2)
+        finally:
+            remote_cache.max_entries = MAX_ENTRIES
+            remote_cache.set_policy("count")
+            del scheme_loaders["count"]
+
+    def test_http_conditional_get(self):
+        body = gzip.compress(b'{"test_key": "{{name}}"}')
+        seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # KEEP-ALIVE
+
+            def do_GET(self):
+                headers = self.headers
+                seen.append((self.client_address, headers.get("If-None-Match"), headers.get("Accept-Encoding")))
+                if headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/config.json"
+        try:
+            first = mo_json_config.expand({"$ref": url}, "param://", {"name": "abc"})
+            first.test_key = "changed"
+            second = mo_json_config.expand({"$ref": url}, "param://", {"name": "abc"})
+            self.assertEqual(second, {"test_key": "abc"})
+            self.assertEqual([etag for _, etag, _ in seen], [None, '"v1"'])
+            self.assertIn("gzip", seen[0][2])
+            # ONE CONNECTION
+            self.assertEqual(len({address for address, _, _ in seen}), 1)
+
+            # FORGOTTEN, SO ASKED FOR WITHOUT AN ETag
+            _http.http_cache.invalidate(url)
+            self.assertEqual(len(_http.http_cache), 0)
+            mo_json_config.expand({"$ref": url}, "param://", {"name": "abc"})
+            self.assertEqual(seen[-1][1], None)
+
+            _http.MAX_BYTES = 10
+            _http.http_cache.invalidate()
+            with self.assertRaises("larger than 10 bytes"):
+                mo_json_config.expand({"$ref": url}, "param://", {"name": "abc"})
+        finally:
+            _http.MAX_BYTES = 16 * 1024 * 1024
+            _http.close()
+            server.shutdown()
+            server.server_close()
+
     def test_http(self):
         result = mo_json_config.get(
             "https://raw.githubusercontent.com/klahnakoski/mo-json-config/dev/tests/resources/simple.json"
@@ -552,3 +1208,24 @@ class TestRef(FuzzyTestCase):
 
             # Assert the content matches the expected value
             self.assertEqual(result, {"test_key": "test_value"})
+
+    def test_s3_conditional_get(self):
+        os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+        spans = []
+        with mock_aws():
+            s3 = boto3.client("s3")
+            s3.create_bucket(Bucket="test-bucket")
+            s3.put_object(Bucket="test-bucket", Key="test-key", Body='{"test_key": "test_value"}')
+            try:
+                first = mo_json_config.expand({"$ref": "s3://test-bucket/test-key"}, tracer=spans.append)
+                first.test_key = "changed"
+                second = mo_json_config.expand({"$ref": "s3://test-bucket/test-key"}, tracer=spans.append)
+                self.assertEqual(second, {"test_key": "test_value"})
+                self.assertEqual([span.cache_hit for span in spans], [False, True])
+                self.assertIs(_s3.client("s3"), _s3.client("s3"))
+
+                s3.put_object(Bucket="test-bucket", Key="test-key", Body='{"test_key": "new_value"}')
+                third = mo_json_config.expand({"$ref": "s3://test-bucket/test-key"})
+                self.assertEqual(third, {"test_key": "new_value"})
+            finally:
+                _s3.close()